@@ -1,6 +1,8 @@
 """ Build baseline model."""
 import os
 import string
+from functools import lru_cache
+from multiprocessing import Pool
 from pprint import pprint
 
 import numpy as np
@@ -15,60 +17,110 @@ from nltk.stem.wordnet import WordNetLemmatizer
 from nltk.corpus import wordnet
 from nltk.tokenize import WordPunctTokenizer
 
-from gensim.models import LdaModel
+from gensim.models import LdaModel, LdaMulticore
 from gensim.corpora import Dictionary
+from gensim.matutils import corpus2dense
 
 from tc_data import TopCoder
 import preprocessing_util as P
 
 TC = TopCoder()
+LDA_MODEL_PATH = os.path.join(os.curdir, 'baseline', 'ptma_lda.model')
 
-def clean_and_tokenize(doc):
-    """ clean and tokenize an input document."""
-    lemmatizer = WordNetLemmatizer()
-
+@lru_cache(maxsize=1)
+def get_tc_stopwords():
+    """ Build the stop word set of baseline model once."""
     tc_stopwords = set(stopwords.words('english'))
     tc_stopwords.update(('project', 'overview', 'final', 'submission', 'documentation', 'provid', 'submission', 'deliverables'))
+    return frozenset(tc_stopwords)
+
+@lru_cache(maxsize=1)
+def get_lemmatizer():
+    """ Build the WordNet lemmatizer once."""
+    return WordNetLemmatizer()
 
+@lru_cache(maxsize=2 ** 16)
+def lemmatize(word):
+    """ Memoized lemmatization, the vocabulary is much smaller than the count of tokens."""
+    return get_lemmatizer().lemmatize(word)
+
+def clean_and_tokenize(doc):
+    """ clean and tokenize an input document."""
     word_only_doc = P.remove_digits(P.remove_punctuation(P.remove_url(doc.lower())))
-    lemmatized_doc = ' '.join([lemmatizer.lemmatize(word) for word in word_only_doc.split()])
-    clean_doc = P.remove_stop_words_from_str(lemmatized_doc, stop_words=tc_stopwords)
+    lemmatized_doc = ' '.join([lemmatize(word) for word in word_only_doc.split()])
+    clean_doc = P.remove_stop_words_from_str(lemmatized_doc, stop_words=get_tc_stopwords())
 
     return P.tokenize_str(clean_doc, min_len=-1, max_len=10000)
 
-def train_lda_model():
-    """ Train the LDA model with topcoder selected challenges requirements."""
+def batch_clean_and_tokenize(docs, n_jobs=None, chunksize=64):
+    """ Clean and tokenize a list of documents, sharding the documents across processes.
+
+        :param n_jobs: number of processes, default to `os.cpu_count()`. `1` runs in current process
+        :param chunksize: number of documents sent to a worker process at a time
+    """
+    # load the WordNet corpus and stop words before forking so every worker inherits them
+    lemmatize('challenge')
+    get_tc_stopwords()
+
+    if n_jobs == 1:
+        return [clean_and_tokenize(doc) for doc in docs]
+
+    with Pool(processes=n_jobs) as pool:
+        return pool.map(clean_and_tokenize, docs, chunksize=chunksize)
+
+def train_lda_model(multicore=True, workers=None, passes=50, random_state=42):
+    """ Train the LDA model with topcoder selected challenges requirements.
+
+        :param multicore: use `LdaMulticore` to parallelize the E-step over worker processes
+        :param workers: number of worker processes, default to `cpu_count - 1` as gensim suggests
+        :param random_state: seed of the model so that retraining is deterministic
+    """
     print('Start processing doc.')
-    clean_docs = [clean_and_tokenize(doc) for doc in TC.get_filtered_requirements().requirements.tolist()]
+    clean_docs = batch_clean_and_tokenize(TC.get_filtered_requirements().requirements.tolist())
     dictionary = Dictionary(clean_docs)
     
     corpus = [dictionary.doc2bow(doc) for doc in clean_docs]
 
     print('Training LDA...')
-    lda = LdaModel(corpus=corpus, num_topics=10, id2word=dictionary, passes=50)
-    lda.save('./baseline/ptma_lda.model')
+    if multicore:
+        workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        lda = LdaMulticore(corpus=corpus, num_topics=10, id2word=dictionary, passes=passes, workers=workers, random_state=random_state)
+    else:
+        lda = LdaModel(corpus=corpus, num_topics=10, id2word=dictionary, passes=passes, random_state=random_state)
+    lda.save(LDA_MODEL_PATH)
+    load_lda_model.cache_clear() # drop the stale model so the next inference picks up the new one
 
     pprint(lda.top_topics(corpus))
 
-def get_lda_ditribution(doc):
-    """ Get lda probability."""
-    lda = LdaModel.load('./baseline/ptma_lda.model')
-    dictionary = Dictionary([doc])
-    corpus = dictionary.doc2bow(doc)
+@lru_cache(maxsize=None)
+def load_lda_model(model_path=LDA_MODEL_PATH):
+    """ Load the trained LDA model once per process.
+        The `expElogbeta` array is memory mapped instead of read into memory.
+    """
+    return LdaModel.load(model_path, mmap='r')
+
+def get_lda_distribution_matrix(docs, lda=None):
+    """ Infer the topic distribution of a list of tokenized documents in one pass.
+        The trained dictionary of the LDA model is used to build the bag of words,
+        return a dense array of shape (n_docs, num_topics).
+    """
+    if lda is None:
+        lda = load_lda_model()
 
-    lda_dist_vec = np.zeros(10)
-    for idx, prob in lda[corpus]:
-        lda_dist_vec[idx] = prob
+    corpus = [lda.id2word.doc2bow(doc) for doc in docs]
 
-    return lda_dist_vec
+    return corpus2dense(lda[corpus], num_terms=lda.num_topics, num_docs=len(corpus)).T
+
+def get_lda_ditribution(doc):
+    """ Get lda probability of a single tokenized document."""
+    return get_lda_distribution_matrix([doc])[0]
 
 def predict_target():
     """ Predicting targets using LogisticRegerssion"""
     req = TC.get_filtered_requirements()
-    clean_req = req.requirements.apply(clean_and_tokenize)
-    req_lda_dist = clean_req.apply(get_lda_ditribution)
+    clean_req = batch_clean_and_tokenize(req.requirements.tolist())
 
-    X = pd.DataFrame(req_lda_dist.tolist(), index=req_lda_dist.index)
+    X = pd.DataFrame(get_lda_distribution_matrix(clean_req), index=req.index)
 
     for target in ('total_prize', 'avg_score', 'number_of_registration', 'sub_reg_ratio'):
         print(f'Predicting target: {target} ...')
@@ -0,0 +1,142 @@
+""" Equivalence checks and throughput benchmark of the implementations of
+    the precision and recall for regression in `imbalanced_regression_metrics`.
+
+    The NumPy implementation is the reference: the TF, graph compiled TF and streaming Keras metric
+    implementations have to agree with it on random inputs for single sided and two sided `c`,
+    then all of them are timed across vector sizes and the throughput is appended to the history
+    in `result/benchmark/imbalanced_metrics_history.json` to compare a new scoring engine with the previous runs.
+"""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from imbalanced_regression_metrics import PrecisionRecallFscoreForRegression
+from tf_imbalanced_regression_metrics import TFPrecisionRecallFscoreForRegression, StreamingPrecisionRecallFscoreForRegression
+from benchmark_util import append_history
+
+METRIC_CASES = {
+    'avg_score_low': dict(tE=0.6, tL=3, c=90, extreme='low', decay=0.1),
+    'number_of_registration_high': dict(tE=0.6, tL=8, c=30, extreme='high'),
+    'sub_reg_ratio_high': dict(tE=0.6, tL=0.07, c=0.25, extreme='high'),
+    'two_sided': dict(tE=0.6, tL=5, c=(20., 80.), extreme='both'),
+    'two_sided_sharp_alpha': dict(tE=0.8, tL=5, c=(20., 80.), extreme='both', use_smoother_alpha=False),
+}
+
+SCORES = ('precision', 'recall', 'fscore')
+HISTORY_FN = os.path.join(os.curdir, 'result', 'benchmark', 'imbalanced_metrics_history.json')
+
+def sample_inputs(metric_args: dict, size: int, rng: np.random.Generator):
+    """ Random ground truth spread around the control point(s) `c` and predictions off by about `tL`."""
+    c_low, c_high = metric_args['c'] if isinstance(metric_args['c'], tuple) else (metric_args['c'], metric_args['c'])
+    spread = max(abs(c_high - c_low), abs(c_high), 1e-3)
+
+    y_true = rng.uniform(c_low - spread, c_high + spread, size)
+    y_pred = y_true + rng.normal(0, metric_args['tL'], size)
+    return y_true.astype(np.float32), y_pred.astype(np.float32)
+
+def compute_scores(metric_args: dict, y_true: np.ndarray, y_pred: np.ndarray, batch_size=4096):
+    """ Compute precision, recall and F-score with every implementation, return a dict of implementation to scores."""
+    prf = PrecisionRecallFscoreForRegression(**metric_args)
+    tf_prf = TFPrecisionRecallFscoreForRegression(**metric_args)
+    tf_y_true, tf_y_pred = tf.constant(y_true), tf.constant(y_pred)
+
+    streaming = {}
+    for score in SCORES:
+        metric = StreamingPrecisionRecallFscoreForRegression(**metric_args, score=score)
+        for start in range(0, len(y_true), batch_size):
+            metric.update_state(y_true[start:start + batch_size], y_pred[start:start + batch_size])
+        streaming[score] = float(metric.result())
+
+    return {
+        'numpy': {score: float(getattr(prf, score)(y_true.astype(np.float64), y_pred.astype(np.float64))) for score in SCORES},
+        'tf': {score: float(getattr(tf_prf, score)(tf_y_true, tf_y_pred)) for score in SCORES},
+        'streaming': streaming,
+    }
+
+def check_equivalence(num_trials=20, sizes=(1, 10, 1000, 10000), rtol=1e-4, atol=1e-5, seed=42):
+    """ Check that the TF and streaming implementations agree with the NumPy implementation on random inputs.
+        A score with no relevant value is 0 in NumPy and NaN in `TFPrecisionRecallFscoreForRegression`,
+        both are taken as equal.
+
+        Return the `pd.DataFrame` of the mismatches, empty when all the implementations agree.
+    """
+    rng = np.random.default_rng(seed)
+    mismatches = []
+    for case, metric_args in METRIC_CASES.items():
+        for size in sizes:
+            for trial in range(num_trials):
+                y_true, y_pred = sample_inputs(metric_args, size, rng)
+                scores = compute_scores(metric_args, y_true, y_pred)
+
+                for impl in ('tf', 'streaming'):
+                    for score in SCORES:
+                        expected, actual = scores['numpy'][score], scores[impl][score]
+                        if expected == 0 and np.isnan(actual):
+                            continue
+                        if not np.isclose(actual, expected, rtol=rtol, atol=atol):
+                            mismatches.append({'case': case, 'size': size, 'trial': trial, 'impl': impl, 'score': score, 'expected': expected, 'actual': actual})
+
+    return pd.DataFrame(mismatches)
+
+def time_fn(fn, repeats=3):
+    """ Best wall time of `repeats` calls of `fn`."""
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmark(sizes=(int(1e3), int(1e4), int(1e5), int(1e6), int(1e7)), repeats=3, seed=42):
+    """ Time the F-score (which computes precision and recall) of every implementation across vector sizes.
+
+        Return a `pd.DataFrame` with the best time and the throughput in values/sec of every case, size and implementation.
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    for case, metric_args in METRIC_CASES.items():
+        prf = PrecisionRecallFscoreForRegression(**metric_args)
+        tf_prf = TFPrecisionRecallFscoreForRegression(**metric_args)
+        tf_fscore = tf.function(tf_prf.fscore, experimental_relax_shapes=True)
+        metric = StreamingPrecisionRecallFscoreForRegression(**metric_args)
+
+        for size in sizes:
+            y_true, y_pred = sample_inputs(metric_args, size, rng)
+            np_y_true, np_y_pred = y_true.astype(np.float64), y_pred.astype(np.float64)
+            tf_y_true, tf_y_pred = tf.constant(y_true), tf.constant(y_pred)
+
+            def run_streaming():
+                metric.reset_states()
+                metric.update_state(tf_y_true, tf_y_pred)
+                return metric.result().numpy()
+
+            impls = {
+                'numpy': lambda: prf.fscore(np_y_true, np_y_pred),
+                'tf': lambda: tf_prf.fscore(tf_y_true, tf_y_pred).numpy(),
+                'tf_function': lambda: tf_fscore(tf_y_true, tf_y_pred).numpy(),
+                'streaming': run_streaming,
+            }
+            for impl, fn in impls.items():
+                fn() # warm up, e.g. tracing
+                seconds = time_fn(fn, repeats)
+                records.append({'case': case, 'size': size, 'impl': impl, 'seconds': seconds, 'values_per_sec': size / seconds})
+                print(f'{case} | {impl} | size {size}: {seconds * 1000:.2f} ms')
+
+    return pd.DataFrame(records)
+
+def main():
+    mismatch_df = check_equivalence()
+    if not mismatch_df.empty:
+        print(mismatch_df)
+        raise AssertionError(f'{len(mismatch_df)} scores differ between the implementations.')
+    print('All the implementations agree.')
+
+    bench_df = benchmark()
+    history_df = append_history(bench_df, HISTORY_FN)
+    print(history_df.pivot_table(index=['case', 'size'], columns=['run', 'impl'], values='values_per_sec'))
+
+if __name__ == "__main__":
+    main()
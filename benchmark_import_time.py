@@ -0,0 +1,73 @@
+""" Import time benchmark of the modules the non deep learning workloads start from.
+
+    Every module is imported in a fresh interpreter, so nothing is cached from a previous import,
+    the wall time of the import and whether TensorFlow or transformers got loaded along are recorded
+    and appended to the history in `result/benchmark/import_time_history.json`.
+"""
+import os
+import sys
+import json
+import subprocess
+
+import pandas as pd
+
+from benchmark_util import append_history
+
+MODULES = (
+    'tc_data',
+    'imbalanced_regression_metrics',
+    'final_model_selection',
+    'boosting_learn',
+    'baseline_modeling',
+    'word2vec_embedding',
+)
+
+HEAVY_PACKAGES = ('tensorflow', 'transformers')
+HISTORY_FN = os.path.join(os.curdir, 'result', 'benchmark', 'import_time_history.json')
+
+IMPORT_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, **{{pkg: pkg in sys.modules for pkg in {packages!r}}}}}))
+"""
+
+def time_import(module: str):
+    """ Import `module` in a new interpreter, return a dict of the import seconds and the heavy packages it loaded."""
+    proc = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT.format(module=module, packages=HEAVY_PACKAGES)],
+        cwd=os.curdir,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        print(f'{module} | import failed:\n{proc.stderr}')
+        return {'seconds': None, **{pkg: None for pkg in HEAVY_PACKAGES}}
+
+    return json.loads(proc.stdout.strip().split('\n')[-1])
+
+def benchmark(modules=MODULES, repeats=3):
+    """ Time the import of every module, keep the best of `repeats` fresh interpreters.
+
+        Return a `pd.DataFrame` with the import seconds and the loaded heavy packages of every module.
+    """
+    records = []
+    for module in modules:
+        runs = [time_import(module) for _ in range(repeats)]
+        timed = [run for run in runs if run['seconds'] is not None]
+        best = min(timed, key=lambda run: run['seconds']) if timed else runs[0]
+
+        records.append({'module': module, **best})
+        loaded = [pkg for pkg in HEAVY_PACKAGES if best[pkg]]
+        print(f'{module}: {best["seconds"] if best["seconds"] is None else round(best["seconds"], 3)} s, loads {loaded or "nothing heavy"}')
+
+    return pd.DataFrame(records)
+
+def main():
+    bench_df = benchmark()
+    history_df = append_history(bench_df, HISTORY_FN)
+    print(history_df.pivot_table(index='module', columns='run', values='seconds'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+""" Helpers shared by the benchmark scripts."""
+import os
+from datetime import datetime
+
+import pandas as pd
+
+def append_history(bench_df: pd.DataFrame, history_fn):
+    """ Append the benchmark of this run, tagged with its timestamp, to the history in `history_fn`."""
+    bench_df = bench_df.assign(run=datetime.now().strftime('%Y%m%d-%H%M%S'))
+    if os.path.isfile(history_fn):
+        bench_df = pd.concat([pd.read_json(history_fn, orient='index'), bench_df], ignore_index=True)
+
+    os.makedirs(os.path.dirname(history_fn), exist_ok=True)
+    bench_df.to_json(history_fn, orient='index', indent=4)
+    return bench_df
@@ -0,0 +1,123 @@
+""" Bulk inference of TCPM models over the whole challenge corpus.
+
+    The texts are tokenized without padding and sorted by token length, so every batch holds
+    texts of similar length and is padded only to its own longest text. The batches run on a thread pool
+    and the predictions are put back in the original order, keyed by challenge id.
+"""
+import os
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+import numpy as np
+import pandas as pd
+
+import tensorflow as tf
+from transformers import AutoConfig, AutoTokenizer, TFDistilBertModel
+
+from tc_data import TopCoder
+from model_tcpm_distilbert import build_tcpm_model_distilbert_regression, tcpm_logits
+
+load_dotenv()
+
+def build_length_sorted_batches(encoded_ids: list, metadata: np.ndarray = None, batch_size=64, pad_token_id=0, pad_to_multiple_of=16):
+    """ Group the unpadded token ids into batches of similar length, each padded to its longest sequence
+        rounded up to `pad_to_multiple_of` to bound the number of distinct shapes the model is traced for.
+
+        Return a list of `(indices, features)`, `indices` being the positions of the batch in `encoded_ids`.
+    """
+    lengths = np.array([len(ids) for ids in encoded_ids])
+    order = np.argsort(lengths, kind='stable')
+
+    batches = []
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        seq_len = int(np.ceil(lengths[indices].max() / pad_to_multiple_of) * pad_to_multiple_of)
+
+        input_ids = np.full((len(indices), seq_len), pad_token_id, dtype=np.int32)
+        attention_mask = np.zeros((len(indices), seq_len), dtype=np.int32)
+        for row, i in enumerate(indices):
+            input_ids[row, :lengths[i]] = encoded_ids[i]
+            attention_mask[row, :lengths[i]] = 1
+
+        features = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if metadata is not None:
+            features['meta_input'] = np.asarray(metadata[indices], dtype=np.float32)
+        batches.append((indices, features))
+
+    return batches
+
+def bulk_predict(model: tf.keras.Model, tokenizer, texts: pd.Series, metadata: np.ndarray = None, batch_size=64, num_threads=4, max_length=512):
+    """ Predict the texts (and metadata rows aligned with them) in length sorted batches.
+
+        :param texts: requirement texts indexed by challenge id
+        :param num_threads: number of batches run concurrently
+        Return a `pd.DataFrame` of the predictions indexed like `texts`, in the same order.
+    """
+    if len(texts) == 0:
+        return pd.DataFrame(columns=['prediction'], index=texts.index, dtype=np.float32)
+
+    encoded_ids = tokenizer(texts.to_list(), truncation=True, max_length=max_length)['input_ids']
+    batches = build_length_sorted_batches(encoded_ids, metadata, batch_size, tokenizer.pad_token_id)
+
+    @tf.function(experimental_relax_shapes=True)
+    def predict(features):
+        return tcpm_logits(model(features, training=False))
+
+    def run_batch(batch):
+        indices, features = batch
+        return indices, predict(features).numpy()
+
+    predictions = None
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for indices, pred in executor.map(run_batch, batches):
+            if predictions is None:
+                predictions = np.empty((len(texts), *pred.shape[1:]), dtype=pred.dtype)
+            predictions[indices] = pred
+
+    predictions = predictions.reshape(len(texts), -1)
+    columns = ['prediction'] if predictions.shape[1] == 1 else [f'prediction_{i}' for i in range(predictions.shape[1])]
+    return pd.DataFrame(predictions, index=texts.index, columns=columns)
+
+def write_predictions(pred_df: pd.DataFrame, output_fn):
+    """ Write the predictions column-wise, as parquet when `output_fn` ends with `.parquet` else as json."""
+    os.makedirs(os.path.dirname(output_fn) or os.curdir, exist_ok=True)
+    pred_df = pred_df.rename_axis('challenge_id')
+    if output_fn.endswith('.parquet'):
+        pred_df.to_parquet(output_fn)
+    else:
+        pred_df.to_json(output_fn, orient='columns', indent=4)
+
+def score_all_challenges(weights_fn, output_fn=None, batch_size=64, num_threads=4):
+    """ Re-score every challenge with a trained `build_tcpm_model_distilbert_regression` model.
+
+        :param weights_fn: weights of the model, e.g. the best weights `<log_dir>/checkpoints/best/weights`
+        written by `run_nn_regression.run_bert_meta_regression_tfmodel`
+    """
+    tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
+    config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=1)
+    model = build_tcpm_model_distilbert_regression(TFDistilBertModel.from_pretrained(os.getenv('MODEL_NAME'), config=config))
+    model.load_weights(weights_fn)
+
+    tc = TopCoder()
+    req = tc.get_filtered_requirements()
+    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True, return_df=True).reindex(req.index)
+
+    pred_df = bulk_predict(model, tokenizer, req['requirements'], metadata.to_numpy(dtype=np.float32), batch_size, num_threads)
+
+    output_fn = output_fn or os.path.join(os.getenv('OUTPUT_DIR'), f'tcpm_scores_{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+    write_predictions(pred_df, output_fn)
+    print(f'Scored {len(pred_df)} challenges into {output_fn}')
+
+    return pred_df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Re-score every challenge with a trained TCPM regression model.')
+    parser.add_argument('weights_fn', help='weights of the model, e.g. <log_dir>/checkpoints/best/weights of run_bert_meta_regression_tfmodel')
+    parser.add_argument('--output_fn', default=None, help='.json or .parquet file, default to a timestamped json in OUTPUT_DIR')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_threads', type=int, default=4)
+    args = parser.parse_args()
+
+    score_all_challenges(args.weights_fn, args.output_fn, args.batch_size, args.num_threads)
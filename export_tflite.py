@@ -0,0 +1,158 @@
+""" Export trained TCPM models into quantized TFLite artifacts for CPU inference.
+
+    The exported model is converted with dynamic-range quantization, i.e. the weights are stored
+    as int8 and the activations are computed in float, which needs no calibration data.
+"""
+import os
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from sklearn.metrics import mean_absolute_error
+
+from input_pipeline import ENCODED_TEXT_KEYS
+from model_tcpm_distilbert import tcpm_logits
+
+def export_tflite_model(model: tf.keras.Model, export_fn, seq_len=512, meta_dim=35, quantize=True):
+    """ Convert a TCPM model that takes `{'input_ids', 'attention_mask', 'meta_input'}` into a TFLite flatbuffer.
+        The sequence dimension is fixed to `seq_len` (the converter of TF 2.2 only supports `None` in the batch dimension),
+        use the padded length of the training data, `TFLitePredictor` pads the inputs to it.
+
+        :param quantize: apply dynamic-range int8 quantization of the weights
+    """
+    @tf.function(input_signature=[{
+        **{k: tf.TensorSpec(shape=(None, seq_len), dtype=tf.int32, name=k) for k in ENCODED_TEXT_KEYS},
+        'meta_input': tf.TensorSpec(shape=(None, meta_dim), dtype=tf.float32, name='meta_input'),
+    }])
+    def serving(inputs):
+        return tcpm_logits(model(inputs, training=False))
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([serving.get_concrete_function()])
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    # fall back to TF kernels for the few DistilBERT ops that have no TFLite builtin
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+    os.makedirs(os.path.dirname(export_fn) or os.curdir, exist_ok=True)
+    with open(export_fn, 'wb') as fwrite:
+        fwrite.write(converter.convert())
+
+    return export_fn
+
+class TFLitePredictor:
+    """ Batched inference with an exported TCPM TFLite model."""
+
+    def __init__(self, model_fn, **interpreter_kwargs):
+        self.interpreter = tf.lite.Interpreter(model_path=model_fn, **interpreter_kwargs)
+        self.input_details = {
+            k: detail for detail in self.interpreter.get_input_details()
+            for k in (*ENCODED_TEXT_KEYS, 'meta_input') if k in detail['name']
+        }
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.seq_len = int(self.input_details['input_ids']['shape'][1])
+        self.batch_size = None
+
+    def pad_features(self, features: dict):
+        """ Right-pad (or truncate) the encoded text to the sequence length of the exported model
+            and cast the features to its input dtypes.
+        """
+        padded = {}
+        for k, arr in features.items():
+            arr = np.asarray(arr)
+            if k in ENCODED_TEXT_KEYS:
+                arr = np.pad(arr[:, :self.seq_len], ((0, 0), (0, max(0, self.seq_len - arr.shape[1]))))
+            padded[k] = arr.astype(self.input_details[k]['dtype'], copy=False)
+        return padded
+
+    def resize(self, batch_size):
+        """ Resize the input tensors to `batch_size`, only when it changes."""
+        if self.batch_size != batch_size:
+            for detail in self.input_details.values():
+                self.interpreter.resize_tensor_input(detail['index'], [batch_size, *detail['shape'][1:]])
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def invoke(self, padded: dict):
+        """ Run the interpreter on a batch of `pad_features` the input tensors have been resized to."""
+        for k, detail in self.input_details.items():
+            self.interpreter.set_tensor(detail['index'], padded[k])
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self.output_index)
+
+    def predict_on_batch(self, features: dict):
+        """ Pad and run one batch."""
+        padded = self.pad_features(features)
+        self.resize(len(padded['meta_input']))
+        return self.invoke(padded)
+
+    def predict(self, features: dict, batch_size=32):
+        """ Predict a dict of arrays in batches."""
+        num_samples = len(features['meta_input'])
+        return np.concatenate([
+            self.predict_on_batch({k: arr[start:start + batch_size] for k, arr in features.items()})
+            for start in range(0, num_samples, batch_size)
+        ])
+
+def compare_with_original(model: tf.keras.Model, predictor: TFLitePredictor, dataset: tf.data.Dataset, report_fn=None, task='regression'):
+    """ Compare accuracy and latency of the original model and the exported TFLite model
+        on a batched held-out dataset of `(features, y)`.
+        Both models are timed on the same batches padded to the sequence length of the TFLite model,
+        the resizing of the interpreter inputs is left out of the timing.
+
+        :param task: "regression" reports MAE/MRE of the predictions, "classification" the accuracy
+        of the argmax of the logits and how often both models agree on it
+    """
+    if task not in ('regression', 'classification'):
+        raise ValueError(f'`task` should be either "regression" or "classification", received {task}')
+
+    y_true, y_original, y_tflite = [], [], []
+    original_time, tflite_time = 0, 0
+
+    for features, y in dataset:
+        padded = predictor.pad_features({k: v.numpy() for k, v in features.items()})
+        predictor.resize(len(padded['meta_input']))
+
+        start = time.perf_counter()
+        y_original.append(np.asarray(tcpm_logits(model(padded, training=False))))
+        original_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        y_tflite.append(predictor.invoke(padded))
+        tflite_time += time.perf_counter() - start
+
+        y_true.append(y.numpy().reshape(-1))
+
+    y_true, y_original, y_tflite = np.concatenate(y_true), np.concatenate(y_original), np.concatenate(y_tflite)
+    report = {'num_samples': len(y_true), 'seq_len': predictor.seq_len}
+
+    if task == 'regression':
+        y_original, y_tflite = y_original.reshape(-1), y_tflite.reshape(-1)
+        report.update({
+            'original_mae': mean_absolute_error(y_true, y_original),
+            'tflite_mae': mean_absolute_error(y_true, y_tflite),
+            'original_mre': np.mean(np.abs(y_true - y_original) / y_true),
+            'tflite_mre': np.mean(np.abs(y_true - y_tflite) / y_true),
+        })
+    else:
+        label_original, label_tflite = np.argmax(y_original, axis=-1), np.argmax(y_tflite, axis=-1)
+        report.update({
+            'original_accuracy': np.mean(label_original == y_true),
+            'tflite_accuracy': np.mean(label_tflite == y_true),
+            'argmax_agreement': np.mean(label_original == label_tflite),
+        })
+
+    report.update({
+        'max_abs_prediction_diff': np.max(np.abs(y_original - y_tflite)),
+        'original_ms_per_sample': original_time * 1000 / len(y_true),
+        'tflite_ms_per_sample': tflite_time * 1000 / len(y_true),
+    })
+    report = {k: v if k in ('num_samples', 'seq_len') else float(v) for k, v in report.items()}
+
+    if report_fn is not None:
+        with open(report_fn, 'w') as fwrite:
+            json.dump(report, fwrite, indent=4)
+
+    return report
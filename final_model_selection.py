@@ -4,6 +4,8 @@
 
 import os
 import json
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 from pprint import pprint
 from datetime import datetime
@@ -12,8 +14,6 @@ import joblib
 import numpy as np
 import pandas as pd
 
-import tensorflow as tf
-
 from sklearn.linear_model import BayesianRidge
 from sklearn.svm import SVR
 from sklearn.gaussian_process import GaussianProcessRegressor
@@ -57,10 +57,12 @@ def mre(y_true, y_pred):
 
 def tfmre(y_true, y_pred):
     """ Calculate mre, TensorFlow version for metrics."""
+    import tensorflow as tf
     return tf.math.reduce_mean(tf.math.abs(y_true - y_pred) / y_true)
 
 def build_sequential_neural_network(num_hidden_layers=2, dimension=64, input_shape=(128,)):
     """ Build sequential model with given hidden layer and dimensions."""
+    import tensorflow as tf
     return tf.keras.Sequential([
         tf.keras.layers.InputLayer(input_shape=input_shape, name=f'input_layer'),
         *[tf.keras.layers.Dense(dimension, activation='relu', name=f'layer_{i}') for i in range(num_hidden_layers)],
@@ -152,7 +154,7 @@ def random_serach_top_tiers():
 
     for target, reg_lst in top_regs_dct.items():
         print(f'{target} | Random Searching....')
-        X, y = tc.build_final_dataset(target)
+        X, y = tc.build_final_dataset(target) # the original column order, the results are column indexed
         Xnp, ynp = X.to_numpy(), y.to_numpy()
         X_train, X_test, y_train, y_test = train_test_split(Xnp, ynp, test_size=0.3, random_state=42)
 
@@ -241,8 +243,55 @@ def kfold_predict_validate_gradient_boosting(X: pd.DataFrame, y: pd.Series, cv=1
 
     return y_pred, pd.DataFrame.from_records(cv_eval_res), overall_score, pd.DataFrame(cv_feature_importance, columns=X.columns)
 
-def kfold_predict_validate_neural_network(X: pd.DataFrame, y: pd.Series, cv=10, num_hidden_layer=2, dimension=64, es_min_delta=1):
-    """ Perform KFold predict and validation on the whole dataset."""
+def init_nn_fold_worker(intra_op_threads: int, inter_op_threads: int):
+    """ Initializer of the fold worker processes, limit the TF thread pools of the process
+        so that the parallel folds don't oversubscribe the cores.
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+def fit_predict_nn_fold(X_train, y_train, X_test, num_hidden_layer=2, dimension=64, es_min_delta=1):
+    """ Scale, train and predict one fold of `kfold_predict_validate_neural_network`."""
+    import tensorflow as tf
+    scaler = StandardScaler().fit(X_train)
+    normer = Normalizer().fit(X_train)
+    X_train = normer.transform(scaler.transform(X_train))
+    X_test = normer.transform(scaler.transform(X_test))
+
+    nnreg = build_sequential_neural_network(
+        num_hidden_layer,
+        dimension,
+        input_shape=X_train.shape[1]
+    )
+    nnreg.compile(
+        optimizer=tf.keras.optimizers.RMSprop(0.0015),
+        loss='mse',
+        metrics=['mse', 'mae', tfmre],
+    )
+    escb = tf.keras.callbacks.EarlyStopping(
+        monitor='val_loss',
+        min_delta=es_min_delta,
+        patience=5,
+        verbose=1,
+    )
+    nnreg.fit(
+        X_train,
+        y_train,
+        epochs=500,
+        validation_split=0.2,
+        batch_size=16,
+        callbacks=[escb]
+    )
+
+    return nnreg.predict(X_test).reshape(-1)
+
+def kfold_predict_validate_neural_network(X: pd.DataFrame, y: pd.Series, cv=10, num_hidden_layer=2, dimension=64, es_min_delta=1, n_jobs=1, threads_per_job=None):
+    """ Perform KFold predict and validation on the whole dataset.
+
+        :param n_jobs: number of folds trained in parallel processes, -1 for one per core up to `cv`
+        :param threads_per_job: TF intra-op threads of every fold process, default to the cores divided by `n_jobs`
+    """
     if not all(X.index == y.index):
         raise ValueError('Index of X and y are not equal!')
 
@@ -250,29 +299,177 @@ def kfold_predict_validate_neural_network(X: pd.DataFrame, y: pd.Series, cv=10,
     cha_id_arr = np.array(X.index)
 
     Xnp, ynp = X.to_numpy(), y.to_numpy()
+    folds = list(kfold.split(Xnp))
+    fold_args = [(Xnp[train_idx], ynp[train_idx], Xnp[test_idx], num_hidden_layer, dimension, es_min_delta) for train_idx, test_idx in folds]
+
+    if n_jobs == -1:
+        n_jobs = min(cv, os.cpu_count())
+
+    if n_jobs > 1:
+        threads_per_job = threads_per_job or max(1, os.cpu_count() // n_jobs)
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=mp.get_context('spawn'), # a fresh TF runtime for every worker
+            initializer=init_nn_fold_worker,
+            initargs=(threads_per_job, 1),
+        ) as executor:
+            fold_pred = list(executor.map(fit_predict_nn_fold, *zip(*fold_args)))
+    else:
+        fold_pred = [fit_predict_nn_fold(*args) for args in fold_args]
 
     pred_sr_lst = []
     cv_eval_res = []
 
+    for (train_idx, test_idx), y_p in zip(folds, fold_pred):
+        y_test = ynp[test_idx]
+        test_cha_id = cha_id_arr[test_idx]
+
+        pred_sr_lst.append(pd.Series(y_p, index=test_cha_id))
+
+        cv_eval_res.append({
+            'r2': r2_score(y_test, y_p),
+            'mae': mean_absolute_error(y_test, y_p),
+            'mse': mean_squared_error(y_test, y_p),
+            'mre': mre(y_test, y_p)
+        })
+
+    y_pred = pd.concat(pred_sr_lst).reindex(X.index)
+    overall_score = {
+        'r2': r2_score(y, y_pred),
+        'mae': mean_absolute_error(y, y_pred),
+        'mse': mean_squared_error(y, y_pred),
+        'mre': mre(y, y_pred)
+    }
+
+    return y_pred, pd.DataFrame.from_records(cv_eval_res), overall_score
+
+def regression_scores(y_true, y_pred):
+    """ The r2, mae, mse and mre scores of the K-Fold validation."""
+    return {
+        'r2': r2_score(y_true, y_pred),
+        'mae': mean_absolute_error(y_true, y_pred),
+        'mse': mean_squared_error(y_true, y_pred),
+        'mre': mre(y_true, y_pred)
+    }
+
+def fit_predict_gb_fold(X_train, y_train, X_test, loss='ls', tol=0.01, n_iter_no_change=5):
+    """ Train and predict one fold of one target with the gradient boosting of `kfold_predict_validate_gradient_boosting`."""
+    gbreg = GradientBoostingRegressor(
+        n_estimators=2000,
+        loss=loss,
+        tol=tol,
+        n_iter_no_change=n_iter_no_change,
+        validation_fraction=0.2,
+        random_state=42,
+        verbose=1,
+    )
+    gbreg.fit(X_train, y_train)
+
+    return gbreg.predict(X_test), gbreg.feature_importances_
+
+def kfold_predict_validate_gradient_boosting_multi_target(X: pd.DataFrame, Y: pd.DataFrame, param_dct: Optional[dict] = None, cv=10, n_jobs=-1):
+    """ Perform K-Fold validation and prediction for gradient boosting of all the targets in one pass,
+        the folds and the feature scaling are shared, the targets of a fold are trained in parallel.
+        The `total_prize` target doesn't use the `total_prize` feature.
+
+        :param X: the features with `total_prize`, see `TopCoder.build_multi_target_dataset`
+        :param Y: the targets, one column per target
+        :param param_dct: parameters of `kfold_predict_validate_gradient_boosting` of every target
+        Return a dict of target to the outputs of `kfold_predict_validate_gradient_boosting`.
+    """
+    if not all(X.index == Y.index):
+        raise ValueError('Index of X and Y are not equal!')
+
+    param_dct = param_dct or {}
+    kfold = KFold(n_splits=cv)
+    cha_id_arr = np.array(X.index)
+
+    Xnp, Ynp = X.to_numpy(), Y.to_numpy()
+    # a column slice (no copy) when the prize is the last column like `TopCoder.build_multi_target_dataset`
+    features_without_prize = slice(None, -1) if X.columns[-1] == 'total_prize' else X.columns != 'total_prize'
+    target_features = {target: features_without_prize if target == 'total_prize' else slice(None) for target in Y.columns}
+
+    pred_sr_lst = {target: [] for target in Y.columns}
+    cv_feature_importance = {target: [] for target in Y.columns}
+    cv_eval_res = {target: [] for target in Y.columns}
     for train_idx, test_idx in kfold.split(Xnp):
-        X_train, y_train = Xnp[train_idx], ynp[train_idx]
-        X_test, y_test = Xnp[test_idx], ynp[test_idx]
+        # StandardScaler scales every column on its own, the scaled features without the prize are a column subset
+        scaler = StandardScaler().fit(Xnp[train_idx])
+        X_train, X_test = scaler.transform(Xnp[train_idx]), scaler.transform(Xnp[test_idx])
+        test_cha_id = cha_id_arr[test_idx]
+
+        fold_res = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(fit_predict_gb_fold)(
+                X_train[:, target_features[target]],
+                Ynp[train_idx, i],
+                X_test[:, target_features[target]],
+                **param_dct.get(target, {}),
+            )
+            for i, target in enumerate(Y.columns)
+        )
+
+        for i, (target, (y_p, feature_importance)) in enumerate(zip(Y.columns, fold_res)):
+            pred_sr_lst[target].append(pd.Series(y_p, index=test_cha_id))
+            cv_feature_importance[target].append(feature_importance)
+            cv_eval_res[target].append(regression_scores(Ynp[test_idx, i], y_p))
+
+    res = {}
+    for target in Y.columns:
+        y_pred = pd.concat(pred_sr_lst[target]).reindex(X.index)
+        res[target] = (
+            y_pred,
+            pd.DataFrame.from_records(cv_eval_res[target]),
+            regression_scores(Y[target], y_pred),
+            pd.DataFrame(cv_feature_importance[target], columns=X.columns[target_features[target]]),
+        )
+
+    return res
+
+def build_multi_head_neural_network(targets, num_hidden_layers=2, dimension=64, input_shape=(128,)):
+    """ Build a sequential model body shared by one regression head per target."""
+    import tensorflow as tf
+    inputs = tf.keras.Input(shape=input_shape, name='input_layer')
+    x = inputs
+    for i in range(num_hidden_layers):
+        x = tf.keras.layers.Dense(dimension, activation='relu', name=f'layer_{i}')(x)
+
+    outputs = {target: tf.keras.layers.Dense(1, name=target)(x) for target in targets}
+    return tf.keras.Model(inputs=inputs, outputs=outputs, name=f'multi_head_model_h{num_hidden_layers}d{dimension}')
+
+def kfold_predict_validate_multi_head_neural_network(X: pd.DataFrame, Y: pd.DataFrame, cv=10, num_hidden_layer=2, dimension=64, es_min_delta=0):
+    """ Perform KFold predict and validation of all the targets with one multi head neural network per fold.
+        The targets are standardized with the statistics of the training fold so the heads weight the same in the loss.
+
+        :param X: the features without `total_prize` as it's one of the targets, see `TopCoder.build_multi_target_dataset`
+        Return a dict of target to the outputs of `kfold_predict_validate_neural_network`.
+    """
+    import tensorflow as tf
+    if not all(X.index == Y.index):
+        raise ValueError('Index of X and Y are not equal!')
+
+    kfold = KFold(n_splits=cv)
+    cha_id_arr = np.array(X.index)
+
+    Xnp, Ynp = X.to_numpy(), Y.to_numpy()
+
+    pred_sr_lst = {target: [] for target in Y.columns}
+    cv_eval_res = {target: [] for target in Y.columns}
+    for train_idx, test_idx in kfold.split(Xnp):
+        X_train, Y_train = Xnp[train_idx], Ynp[train_idx]
+        X_test, Y_test = Xnp[test_idx], Ynp[test_idx]
         test_cha_id = cha_id_arr[test_idx]
 
         scaler = StandardScaler().fit(X_train)
         normer = Normalizer().fit(X_train)
         X_train = normer.transform(scaler.transform(X_train))
         X_test = normer.transform(scaler.transform(X_test))
+        target_scaler = StandardScaler().fit(Y_train)
 
-        nnreg = build_sequential_neural_network(
-            num_hidden_layer,
-            dimension,
-            input_shape=X.shape[1]
-        )
+        nnreg = build_multi_head_neural_network(Y.columns, num_hidden_layer, dimension, input_shape=X.shape[1])
         nnreg.compile(
             optimizer=tf.keras.optimizers.RMSprop(0.0015),
             loss='mse',
-            metrics=['mse', 'mae', tfmre],
+            metrics=['mae'],
         )
         escb = tf.keras.callbacks.EarlyStopping(
             monitor='val_loss',
@@ -282,32 +479,25 @@ def kfold_predict_validate_neural_network(X: pd.DataFrame, y: pd.Series, cv=10,
         )
         nnreg.fit(
             X_train,
-            y_train,
+            dict(zip(Y.columns, target_scaler.transform(Y_train).T)),
             epochs=500,
             validation_split=0.2,
             batch_size=16,
             callbacks=[escb]
         )
 
-        y_p = nnreg.predict(X_test).reshape(-1)
-        pred_sr_lst.append(pd.Series(y_p, index=test_cha_id))
-
-        cv_eval_res.append({
-            'r2': r2_score(y_test, y_p),
-            'mae': mean_absolute_error(y_test, y_p),
-            'mse': mean_squared_error(y_test, y_p),
-            'mre': mre(y_test, y_p)
-        })
+        pred = nnreg.predict(X_test)
+        Y_p = target_scaler.inverse_transform(np.hstack([pred[target] for target in Y.columns]))
+        for i, target in enumerate(Y.columns):
+            pred_sr_lst[target].append(pd.Series(Y_p[:, i], index=test_cha_id))
+            cv_eval_res[target].append(regression_scores(Y_test[:, i], Y_p[:, i]))
 
-    y_pred = pd.concat(pred_sr_lst).reindex(X.index)
-    overall_score = {
-        'r2': r2_score(y, y_pred),
-        'mae': mean_absolute_error(y, y_pred),
-        'mse': mean_squared_error(y, y_pred),
-        'mre': mre(y, y_pred)
-    }
+    res = {}
+    for target in Y.columns:
+        y_pred = pd.concat(pred_sr_lst[target]).reindex(X.index)
+        res[target] = (y_pred, pd.DataFrame.from_records(cv_eval_res[target]), regression_scores(Y[target], y_pred))
 
-    return y_pred, pd.DataFrame.from_records(cv_eval_res), overall_score
+    return res
 
 def train_gb_for_production(X: pd.DataFrame, y: pd.Series, target: str, loss='ls', tol=0.01, n_iter_no_change=5):
     """ Train Gradient Boosting model for production."""
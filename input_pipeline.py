@@ -0,0 +1,62 @@
+""" Helpers that build `tf.data.Dataset` input pipelines for the TCPM models."""
+import numpy as np
+import tensorflow as tf
+
+ENCODED_TEXT_KEYS = ('input_ids', 'attention_mask')
+SEQUENCE_KEYS = (*ENCODED_TEXT_KEYS, 'hidden_state') # features that have a sequence dimension to trim
+
+def cast_encoded_text(features, label):
+    """ Cast the compact cached token arrays back to the int32 that DistilBERT inputs expect.
+        Used as `dataset.map(cast_encoded_text)` on datasets of `(features, label)`.
+    """
+    return {k: tf.cast(v, tf.int32) if k in ENCODED_TEXT_KEYS else v for k, v in features.items()}, label
+
+def split_train_val_test(dataset, dataset_size, test_fraction=0.2, val_fraction=0.2):
+    """ Split a dataset (shuffled once, so the split is the same on every iteration) into train, validation and test datasets.
+        The validation set is held out of the training portion, for early stopping and best model retention,
+        so that the test set is only used for the final evaluation.
+    """
+    train_size = int(dataset_size * (1 - test_fraction))
+    fit_size = int(train_size * (1 - val_fraction))
+    return dataset.take(fit_size), dataset.take(train_size).skip(fit_size), dataset.skip(train_size)
+
+def trim_batch_padding(features, label):
+    """ Trim the padding columns that every sample of a batch shares,
+        the tokenizer pads on the right so the batch is cut at its longest `attention_mask`.
+    """
+    seq_len = tf.reduce_max(tf.reduce_sum(tf.cast(features['attention_mask'], tf.int32), axis=1))
+    return {k: v[:, :seq_len] if k in SEQUENCE_KEYS else v for k, v in features.items()}, label
+
+def bucket_by_token_length(dataset, batch_size, bucket_boundaries=(64, 128, 256, 384)):
+    """ Batch a dataset of `(features, label)` grouping samples of similar token length,
+        then pad every batch only to its own longest sample instead of the full 512 tokens.
+    """
+    bucketing = tf.data.experimental.bucket_by_sequence_length(
+        element_length_func=lambda features, label: tf.reduce_sum(tf.cast(features['attention_mask'], tf.int32)),
+        bucket_boundaries=list(bucket_boundaries),
+        bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+    )
+    return dataset.apply(bucketing).map(trim_batch_padding, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+def memmap_dataset(features: dict, labels: np.ndarray, indices: np.ndarray, batch_size, shuffle=True, seed=42):
+    """ Batched dataset of `(features, label)` that reads the rows of (memory-mapped) arrays by index,
+        only the rows of each batch are read from disk instead of loading the whole arrays into memory.
+    """
+    keys = list(features.keys())
+
+    def read_rows(idx):
+        idx = np.sort(idx) # read the memory-mapped file in order
+        return [np.asarray(features[k][idx]) for k in keys] + [np.asarray(labels[idx])]
+
+    def to_batch(idx):
+        *values, label = tf.numpy_function(read_rows, [idx], [tf.as_dtype(features[k].dtype) for k in keys] + [tf.as_dtype(labels.dtype)])
+        for k, v in zip(keys, values):
+            v.set_shape((None, *features[k].shape[1:]))
+        label.set_shape((None, *labels.shape[1:]))
+        return dict(zip(keys, values)), label
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(indices, dtype=np.int64))
+    if shuffle:
+        dataset = dataset.shuffle(len(indices), seed=seed)
+
+    return dataset.batch(batch_size).map(to_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
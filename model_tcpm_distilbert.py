@@ -3,7 +3,6 @@
 """
 import os
 import json
-import random
 
 from dotenv import load_dotenv
 
@@ -36,13 +35,15 @@ def ReshapePoolingReshape(pool_size, target_shape_in, input_shape_in, target_sha
         tf.keras.layers.Reshape(target_shape=target_shape_out, input_shape=input_shape_out, name='reshape_output'),
     ], name='reshape_pooling_reshape')
 
-def build_tcpm_model_distilbert_classification(distilbert_model: TFDistilBertModel, config: AutoConfig):
+def build_tcpm_model_distilbert_classification(distilbert_model: TFDistilBertModel, config: AutoConfig, max_seq_len=None):
     """ Build TopCoder Pricing Model(TCPM) using tensorflow functional api
         The builiding process will be very similar to BERT model (using TFBertModel)
 
         The input format of tcpm_model is expected to be:
 
-        ```{'input_ids': Tensor(shape=(512,)), 'attention_mask': Tensor(shape=(512,)), 'meta_input': Tensor(shape=(4,))}```
+        ```{'input_ids': Tensor(shape=(seq_len,)), 'attention_mask': Tensor(shape=(seq_len,)), 'meta_input': Tensor(shape=(4,))}```
+
+        `max_seq_len` of `None` builds a dynamic sequence dimension so that batches can be padded per batch.
     """
     # define layers needed to build the model
     fully_connected_layer = tf.keras.layers.Dense(
@@ -55,7 +56,7 @@ def build_tcpm_model_distilbert_classification(distilbert_model: TFDistilBertMod
     # softmax_layer = tf.keras.layers.Softmax()
 
     # build (distil)bert model pipeline
-    distilbert_input = {k: tf.keras.layers.Input(shape=(512,), dtype=tf.int32, name=k) for k in ('input_ids', 'attention_mask')} # there probably is a better way to get the encoded keys but it works for now
+    distilbert_input = {k: tf.keras.layers.Input(shape=(max_seq_len,), dtype=tf.int32, name=k) for k in ('input_ids', 'attention_mask')} # there probably is a better way to get the encoded keys but it works for now
     distilbert_output = distilbert_model(distilbert_input)
     hidden_state = distilbert_output[0] # (batch_size, seq_len, dimension) get last layer hidden state
     pooled_output = hidden_state[:, 0] # (bs, dimension)
@@ -73,57 +74,249 @@ def build_tcpm_model_distilbert_classification(distilbert_model: TFDistilBertMod
     tcpm_model = tf.keras.Model(inputs=[distilbert_input, meta_input], outputs=output)
     return tcpm_model
 
-def build_tcpm_model_distilbert_regression(distilbert_model: TFDistilBertModel):
-    """ Build TCPM regression nn model."""
+def build_tcpm_regression_head(meta_dim=35, dim=768):
+    """ Build the pooling + metadata + dense head of TCPM regression model.
+        It takes the DistilBERT `[CLS]` hidden state and metadata as input, so it can be trained
+        on cached `[CLS]` embeddings with a frozen encoder and reused on top of the full model.
+    """
     fully_connected_layer = tf.keras.layers.Dense(512, activation='relu', name='fully_connected')
     regression_unit = tf.keras.layers.Dense(1, name='regression')
     pooling_layer = ReshapePoolingReshape(
         pool_size=16,
-        target_shape_in=(1, 768), input_shape_in=(768,),
-        target_shape_out=(48,), input_shape_out=(1, 48)
+        target_shape_in=(1, dim), input_shape_in=(dim,),
+        target_shape_out=(dim // 16,), input_shape_out=(1, dim // 16)
     )
 
+    cls_input = tf.keras.Input(shape=(dim,), dtype=tf.float32, name='cls_embedding')
+    meta_input = tf.keras.Input(shape=(meta_dim,), dtype=tf.float32, name='meta_input')
+
+    pooled_output = pooling_layer(cls_input) # feed [CLS] token repr to pooling
+
+    # concat distilBERT output and metainput
+    concat_layer = tf.keras.layers.concatenate([pooled_output, meta_input], name='concat_bert_meta')
+    x = fully_connected_layer(concat_layer)
+    output = regression_unit(x)
+
+    return tf.keras.Model(inputs=[cls_input, meta_input], outputs=output, name='tcpm_regression_head')
+
+def build_tcpm_model_distilbert_regression(distilbert_model: TFDistilBertModel, head: tf.keras.Model = None, max_seq_len=None):
+    """ Build TCPM regression nn model.
+
+        :param head: a head built by `build_tcpm_regression_head`, pass the head trained
+        on cached embeddings to fine-tune the full model from there.
+        :param max_seq_len: length of the encoded text, `None` for a dynamic sequence dimension
+    """
+    if head is None:
+        head = build_tcpm_regression_head()
+
     # build input for DistilBERT and metadata.
-    distilbert_input = {k: tf.keras.layers.Input(shape=(512,), dtype=tf.int32, name=k) for k in ('input_ids', 'attention_mask')}
-    meta_input = tf.keras.Input(shape=(35,), dtype=tf.float32, name='meta_input')
+    distilbert_input = {k: tf.keras.layers.Input(shape=(max_seq_len,), dtype=tf.int32, name=k) for k in ('input_ids', 'attention_mask')}
+    meta_input = tf.keras.Input(shape=head.input_shape[1][1:], dtype=tf.float32, name='meta_input')
 
     # distilBERT output
     distilbert_output = distilbert_model(distilbert_input)
     hidden_state = distilbert_output[0] # (batch_size, seq_len, dimension)
     pooled_output = hidden_state[:, 0] # (bs, dimension)
-    pooled_output = pooling_layer(pooled_output) # feed [CLS] token repr to pooling
 
-    # concat distilBERT output and metainput
-    concat_layer = tf.keras.layers.concatenate([pooled_output, meta_input], name='concat_bert_meta')
-    x = fully_connected_layer(concat_layer)
-    output = regression_unit(x)
+    output = head([pooled_output, meta_input])
 
     model = tf.keras.Model(inputs=[distilbert_input, meta_input], outputs=output)
     return model
 
+def build_student_text_encoder(vocab_size=30522, embedding_dim=128, num_filters=256, kernel_sizes=(3, 5, 7), output_dim=768):
+    """ Build a lightweight CNN text encoder over the same WordPiece ids as DistilBERT.
+        It's distilled to reproduce the DistilBERT `[CLS]` embedding, so its output has the same dimension.
+    """
+    text_input = {k: tf.keras.layers.Input(shape=(None,), dtype=tf.int32, name=k) for k in ('input_ids', 'attention_mask')}
+    mask = tf.cast(text_input['attention_mask'], tf.float32)[:, :, tf.newaxis] # (bs, seq_len, 1)
+
+    x = tf.keras.layers.Embedding(vocab_size, embedding_dim, name='wordpiece_embedding')(text_input['input_ids'])
+    x = tf.keras.layers.concatenate([
+        tf.keras.layers.Conv1D(num_filters, kernel_size, padding='same', activation='relu', name=f'conv_{kernel_size}')(x)
+        for kernel_size in kernel_sizes
+    ]) # (bs, seq_len, num_filters * len(kernel_sizes))
+    x = tf.reduce_max(x * mask, axis=1) # max pooling over the unpadded tokens, relu output is non-negative
+    output = tf.keras.layers.Dense(output_dim, name='cls_projection')(x)
+
+    return tf.keras.Model(inputs=text_input, outputs=output, name='student_text_encoder')
+
+def build_tcpm_model_student_regression(student_encoder: tf.keras.Model, head: tf.keras.Model = None):
+    """ Build TCPM regression model on the distilled student encoder,
+        it takes the same inputs as `build_tcpm_model_distilbert_regression` and can replace it.
+    """
+    if head is None:
+        head = build_tcpm_regression_head(dim=student_encoder.output_shape[-1])
+
+    text_input = {k: tf.keras.layers.Input(shape=(None,), dtype=tf.int32, name=k) for k in ('input_ids', 'attention_mask')}
+    meta_input = tf.keras.Input(shape=head.input_shape[1][1:], dtype=tf.float32, name='meta_input')
+
+    output = head([student_encoder(text_input), meta_input])
+
+    return tf.keras.Model(inputs=[text_input, meta_input], outputs=output)
+
+def cache_encoder_outputs(encode, encoded_text: dict, cache_fn: str, shape, dtype, batch_size=64):
+    """ Run `encode` (a `tf.function` of a batch `{'input_ids', 'attention_mask'}` of int32) over the encoded text
+        batch by batch and store its outputs in a memory-mapped array of `shape` and `dtype` at `cache_fn`.
+        An existing cache of matching shape is reused, a new cache is written aside and renamed when complete.
+    """
+    if os.path.isfile(cache_fn):
+        cached = np.load(cache_fn, mmap_mode='r')
+        if cached.shape == tuple(shape):
+            return cached
+
+    tmp_fn = f'{cache_fn}.tmp{os.getpid()}.npy'
+    outputs = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=dtype, shape=tuple(shape))
+    for start in range(0, shape[0], batch_size):
+        batch = {k: tf.cast(encoded_text[k][start:start + batch_size], tf.int32) for k in ('input_ids', 'attention_mask')}
+        outputs[start:start + batch_size] = encode(batch).numpy().astype(dtype, copy=False)
+
+    outputs.flush()
+    del outputs
+    os.replace(tmp_fn, cache_fn)
+
+    return np.load(cache_fn, mmap_mode='r')
+
+def cache_cls_embeddings(distilbert_model: TFDistilBertModel, encoded_text: dict, cache_fn: str, batch_size=64):
+    """ Run the frozen DistilBERT encoder once over the encoded text
+        and store the `[CLS]` hidden state of every challenge in a memory-mapped float32 matrix.
+        An existing cache of matching size is reused.
+    """
+    @tf.function(input_signature=[{k: tf.TensorSpec(shape=(None, None), dtype=tf.int32) for k in ('input_ids', 'attention_mask')}])
+    def encode(batch):
+        return distilbert_model(batch, training=False)[0][:, 0]
+
+    shape = (len(encoded_text['input_ids']), distilbert_model.config.dim)
+    return cache_encoder_outputs(encode, encoded_text, cache_fn, shape, np.float32, batch_size)
+
+def run_distilbert_blocks(blocks, hidden_state, attention_mask, training=False):
+    """ Forward the hidden state through a list of DistilBERT `TFTransformerBlock`."""
+    attention_mask = tf.cast(attention_mask, tf.float32)
+    for block in blocks:
+        hidden_state = block([hidden_state, attention_mask, None, False], training=training)[-1] # inputs: x, attn_mask, head_mask, output_attentions
+    return hidden_state
+
+def cache_lower_block_activations(distilbert_model: TFDistilBertModel, encoded_text: dict, num_frozen_layers, cache_fn: str, batch_size=32):
+    """ Run the embeddings and the bottom `num_frozen_layers` transformer blocks of DistilBERT once
+        and store their output hidden states in a memory-mapped float16 array of shape (n, seq_len, dim).
+        An existing cache of matching shape is reused.
+    """
+    main_layer = distilbert_model.distilbert
+
+    @tf.function(input_signature=[{k: tf.TensorSpec(shape=(None, None), dtype=tf.int32) for k in ('input_ids', 'attention_mask')}])
+    def encode_lower(batch):
+        hidden_state = main_layer.embeddings(batch['input_ids'], training=False)
+        return run_distilbert_blocks(main_layer.transformer.layer[:num_frozen_layers], hidden_state, batch['attention_mask'])
+
+    shape = (*encoded_text['input_ids'].shape, distilbert_model.config.dim)
+    return cache_encoder_outputs(encode_lower, encoded_text, cache_fn, shape, np.float16, batch_size)
+
+class TCPMPartialDistilBertRegression(tf.keras.Model):
+    """ TCPM regression model that only fine-tunes the top transformer blocks of DistilBERT and the head.
+        Its inputs are the cached output of the frozen bottom blocks:
+
+        ```{'hidden_state': (seq_len, dim), 'attention_mask': (seq_len,), 'meta_input': (35,)}```
+    """
+
+    def __init__(self, distilbert_model: TFDistilBertModel, num_frozen_layers, head: tf.keras.Model = None, **kwargs):
+        super().__init__(**kwargs)
+        self.num_frozen_layers = num_frozen_layers
+        self.blocks = distilbert_model.distilbert.transformer.layer[num_frozen_layers:] # weights are shared with `distilbert_model`
+        self.head = head if head is not None else build_tcpm_regression_head(dim=distilbert_model.config.dim)
+
+    def call(self, inputs, training=False):
+        hidden_state = tf.cast(inputs['hidden_state'], tf.float32)
+        hidden_state = run_distilbert_blocks(self.blocks, hidden_state, inputs['attention_mask'], training=training)
+        return self.head([hidden_state[:, 0], inputs['meta_input']], training=training)
+
+def tcpm_logits(output):
+    """ Functional TCPM models return the logits, subclass TCPM models return a tuple led by the logits."""
+    return output[0] if isinstance(output, (tuple, list)) else output
+
+def tcpm_input_signature(meta_dim, seq_len=None):
+    """ Fixed `tf.TensorSpec` of TCPM inputs, the batch and (by default) sequence dimensions are dynamic."""
+    return {
+        'input_ids': tf.TensorSpec(shape=(None, seq_len), dtype=tf.int32, name='input_ids'),
+        'attention_mask': tf.TensorSpec(shape=(None, seq_len), dtype=tf.int32, name='attention_mask'),
+        'meta_input': tf.TensorSpec(shape=(None, meta_dim), dtype=tf.float32, name='meta_input'),
+    }
+
+def tcpm_dummy_inputs(meta_dim, seq_len=512, batch_size=3):
+    """ Deterministic dummy inputs used to build the network,
+        every build traces the same shapes and values.
+    """
+    return {
+        'input_ids': tf.ones((batch_size, seq_len), dtype=tf.int32),
+        'attention_mask': tf.ones((batch_size, seq_len), dtype=tf.int32),
+        'meta_input': tf.zeros((batch_size, meta_dim), dtype=tf.float32),
+    }
+
+def split_tcpm_inputs(inputs, labels=None):
+    """ Split the inputs of TCPM subclass models into (DistilBERT inputs, metadata, labels).
+        The given dict is not mutated so the same inputs can be fed again.
+    """
+    if not isinstance(inputs, (dict, BatchEncoding)):
+        raise TypeError(f'TCPM models take a dict of encoded text and `meta_input` as inputs, got {type(inputs)}')
+    if 'meta_input' not in inputs:
+        raise KeyError(f'You need to include meta_input in the input data to train this model. Keys of input: {list(inputs.keys())}')
+
+    text_inputs = {k: v for k, v in inputs.items() if k not in ('meta_input', 'labels')}
+    return text_inputs, inputs['meta_input'], inputs.get('labels', labels)
+
+class TCPMStepFunctions:
+    """ Graph compiled train and predict steps of a TCPM model with fixed input signatures.
+        `trace_count` records how many times each step has been traced,
+        a steady state training loop should never increase it after the first step.
+    """
+
+    def __init__(self, model, optimizer, loss_fn, meta_dim, seq_len=None, label_dtype=tf.float32, experimental_compile=False):
+        """ :param experimental_compile: compile the steps with XLA"""
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.trace_count = {'train_step': 0, 'predict_step': 0}
+
+        input_signature = tcpm_input_signature(meta_dim, seq_len)
+        label_signature = tf.TensorSpec(shape=(None,), dtype=label_dtype, name='labels')
+
+        self.train_step = tf.function(
+            self._train_step,
+            input_signature=[input_signature, label_signature],
+            experimental_compile=experimental_compile,
+        )
+        self.predict_step = tf.function(
+            self._predict_step,
+            input_signature=[input_signature],
+            experimental_compile=experimental_compile,
+        )
+
+    def logits(self, inputs, training):
+        """ Logits of the model, see `tcpm_logits`."""
+        return tcpm_logits(self.model(inputs, training=training))
+
+    def _train_step(self, inputs, labels):
+        self.trace_count['train_step'] += 1 # python side effect, only runs while tracing
+
+        with tf.GradientTape() as tape:
+            loss = self.loss_fn(labels, self.logits(inputs, training=True))
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+
+        return loss
+
+    def _predict_step(self, inputs):
+        self.trace_count['predict_step'] += 1 # python side effect, only runs while tracing
+        return self.logits(inputs, training=False)
+
 class TCPMDistilBertClassification(TFDistilBertPreTrainedModel, TFSequenceClassificationLoss):
     """ Classification model that takes both encoded text and metadata as input."""
+    meta_dim = 4
+
     @property
     def dummy_inputs(self):
         """ Overt write the parent class dummy inputs
             used to build the network
         """
-        meaningful_encoded_digits = random.randint(12, 512)
-        return {
-            'input_ids': tf.constant(
-                np.concatenate(
-                    (
-                        np.random.randint(1, 1000, (3, meaningful_encoded_digits)),
-                        np.zeros((3, 512 - meaningful_encoded_digits))
-                    ), axis=1), dtype=tf.int32),
-            'attention_mask': tf.constant(
-                np.concatenate(
-                    (
-                        np.ones((3, meaningful_encoded_digits)),
-                        np.zeros((3, 512 - meaningful_encoded_digits))
-                    ), axis=1), dtype=tf.int32),
-            'meta_input': tf.constant(np.random.randint(1, 1000, (3, 4)), dtype=tf.float32)
-        }
+        return tcpm_dummy_inputs(self.meta_dim)
 
 
     def __init__(self, config, *inputs, **kwargs):
@@ -131,7 +324,7 @@ class TCPMDistilBertClassification(TFDistilBertPreTrainedModel, TFSequenceClassi
         self.num_labels = config.num_labels
 
         self.distilbert = TFDistilBertMainLayer(config, name='distilbert')
-        self.metadata_inputs = tf.keras.layers.InputLayer(input_shape=(4,), name='metadata')
+        self.metadata_inputs = tf.keras.layers.InputLayer(input_shape=(self.meta_dim,), name='metadata')
         self.fully_connected = tf.keras.layers.Dense(
             config.dim,
             kernel_initializer=get_initializer(config.initializer_range),
@@ -160,20 +353,7 @@ class TCPMDistilBertClassification(TFDistilBertPreTrainedModel, TFSequenceClassi
             ({'input_ids': (512,), 'attention_mask': (512,), 'meta_input': (4,)})
             which are (encoded_text, metadata)
         """
-        if isinstance(inputs, (tuple, list)):
-            labels = inputs[6] if len(inputs) > 6 else labels
-            if len(inputs) > 6:
-                inputs = inputs[:6]
-        elif isinstance(inputs, (dict, BatchEncoding)):
-            labels = inputs.pop('labels', labels)
-            if 'meta_input' not in inputs:
-                raise KeyError(f'You need to include meta_input in the input data to train this model. Keys of input: {list(inputs.keys())}')
-            meta_input = inputs.pop('meta_input')
-
-        print('Input TCPM call')
-        print(inputs)
-        print(meta_input)
-        print(labels)
+        inputs, meta_input, labels = split_tcpm_inputs(inputs, labels)
 
         distilbert_output = self.distilbert(
             inputs,
@@ -186,54 +366,34 @@ class TCPMDistilBertClassification(TFDistilBertPreTrainedModel, TFSequenceClassi
         )
         hidden_state = distilbert_output[0] # (bs, seq_len, dim)
 
-        # print('Get hidden state of distilbert', hidden_state)
-
         # append metadata after the bert output embeddings
         pooled_output = hidden_state[:, 0] # (bs, dim) gen sentence embedding == embedding of '[CLS]'
         metadata_output = self.metadata_inputs(meta_input)
-        # print('Get meta output', metadata_output)
         concat_output = tf.keras.layers.concatenate([pooled_output, metadata_output])
-        # print('Get concat', concat_output)
 
         # continue forward
         x = self.fully_connected(concat_output)
         # x = self.dropout(x, training=training)
         logits = self.classifier(x)
 
-        # print('logits', logits)
-
         outputs = (logits,) + distilbert_output[1:] # copy-paste from original impolementation
 
         if labels is not None:
             loss = self.compute_loss(labels, logits)
-            # print('get loss', loss)
             outputs = (loss,) + outputs
 
         return outputs # (loss), logits, (hidden_states), (attentions)
 
 class TCPMDistilBertRegression(TFDistilBertPreTrainedModel, TFSequenceClassificationLoss):
     """ Classification model that takes both encoded text and metadata as input."""
+    meta_dim = 35
+
     @property
     def dummy_inputs(self):
         """ Overt write the parent class dummy inputs
             used to build the network
         """
-        meaningful_encoded_digits = random.randint(12, 512)
-        return {
-            'input_ids': tf.constant(
-                np.concatenate(
-                    (
-                        np.random.randint(1, 1000, (3, meaningful_encoded_digits)),
-                        np.zeros((3, 512 - meaningful_encoded_digits))
-                    ), axis=1), dtype=tf.int32),
-            'attention_mask': tf.constant(
-                np.concatenate(
-                    (
-                        np.ones((3, meaningful_encoded_digits)),
-                        np.zeros((3, 512 - meaningful_encoded_digits))
-                    ), axis=1), dtype=tf.int32),
-            'meta_input': tf.constant(np.random.randint(1, 1000, (3, 35)), dtype=tf.float32)
-        }
+        return tcpm_dummy_inputs(self.meta_dim)
 
 
     def __init__(self, config, *inputs, **kwargs):
@@ -241,7 +401,7 @@ class TCPMDistilBertRegression(TFDistilBertPreTrainedModel, TFSequenceClassifica
         self.num_labels = config.num_labels
 
         self.distilbert = TFDistilBertMainLayer(config, name='distilbert')
-        self.metadata_inputs = tf.keras.layers.InputLayer(input_shape=(35,), name='metadata')
+        self.metadata_inputs = tf.keras.layers.InputLayer(input_shape=(self.meta_dim,), name='metadata')
         self.fully_connected = tf.keras.layers.Dense(
             512,
             kernel_initializer=get_initializer(config.initializer_range),
@@ -275,15 +435,7 @@ class TCPMDistilBertRegression(TFDistilBertPreTrainedModel, TFSequenceClassifica
             ({'input_ids': (512,), 'attention_mask': (512,), 'meta_input': (4,)})
             which are (encoded_text, metadata)
         """
-        if isinstance(inputs, (tuple, list)):
-            labels = inputs[6] if len(inputs) > 6 else labels
-            if len(inputs) > 6:
-                inputs = inputs[:6]
-        elif isinstance(inputs, (dict, BatchEncoding)):
-            labels = inputs.pop('labels', labels)
-            if 'meta_input' not in inputs:
-                raise KeyError(f'You need to include meta_input in the input data to train this model. Keys of input: {list(inputs.keys())}')
-            meta_input = inputs.pop('meta_input')
+        inputs, meta_input, labels = split_tcpm_inputs(inputs, labels)
 
         distilbert_output = self.distilbert(
             inputs,
@@ -0,0 +1,99 @@
+""" Launch a TCPM training entry point as several local data-parallel worker processes.
+
+    Every worker is a separate TF runtime pinned to its own slice of the CPU cores,
+    the workers keep a replica of the model each and all-reduce the gradients with
+    `MultiWorkerMirroredStrategy`, so the training throughput scales across the sockets of a node
+    instead of being capped by the intra-op threading of a single runtime.
+
+    The entry point is referenced as `'module:function'` and has to accept a `strategy` keyword argument,
+    it's imported in the worker after `TF_CONFIG` is set since the strategy reads it when TF starts.
+"""
+import os
+import json
+import socket
+import importlib
+import multiprocessing as mp
+from datetime import datetime
+
+def get_worker_info():
+    """ Return `(task_index, num_workers)` of the current process from `TF_CONFIG`, `(0, 1)` when not set."""
+    tf_config = json.loads(os.getenv('TF_CONFIG', '{}'))
+    if not tf_config:
+        return 0, 1
+    return tf_config['task']['index'], len(tf_config['cluster']['worker'])
+
+def is_chief():
+    """ Whether the current process is the worker that writes the outputs of the run."""
+    return get_worker_info()[0] == 0
+
+def find_free_ports(num_ports):
+    """ Ask the OS for `num_ports` free localhost ports."""
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(num_ports)]
+    for sock in sockets:
+        sock.bind(('localhost', 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+def split_cpus(num_workers):
+    """ Split the CPUs available to this process into `num_workers` contiguous slices,
+        contiguous core ids are usually on the same socket.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    size = max(1, len(cpus) // num_workers)
+    return [cpus[i * size:(i + 1) * size] or cpus for i in range(num_workers)]
+
+def run_worker(task_index: int, cluster: list, entry: str, cpus: list, kwargs: dict):
+    """ Worker process: set up `TF_CONFIG` and the CPU affinity, then run the entry point under the strategy."""
+    os.environ['TF_CONFIG'] = json.dumps({
+        'cluster': {'worker': cluster},
+        'task': {'type': 'worker', 'index': task_index},
+    })
+    os.environ['OMP_NUM_THREADS'] = str(len(cpus))
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy(
+        communication=tf.distribute.experimental.CollectiveCommunication.RING
+    )
+
+    module_name, fn_name = entry.split(':')
+    getattr(importlib.import_module(module_name), fn_name)(strategy=strategy, **kwargs)
+
+def launch_local_workers(entry: str, num_workers=2, run_dir_arg='log_dir', **kwargs):
+    """ Run `entry` in `num_workers` local worker processes and wait for all of them.
+
+        :param entry: training entry point as `'module:function'`, e.g. `'run_nn_regression:run_bert_meta_regression_tfmodel'`
+        :param run_dir_arg: keyword argument of the entry point that sets its output (and checkpoint) directory,
+        e.g. `'ckpt_dir'` for `run_nn_classification:finetune_tcpm_as_tfmodel`. When it's not given, one timestamped
+        directory in `OUTPUT_DIR` is made here and shared by all the workers, pass the directory of an interrupted run to resume it
+        :param kwargs: keyword arguments of the entry point, the same for every worker
+    """
+    if run_dir_arg and kwargs.get(run_dir_arg) is None:
+        kwargs[run_dir_arg] = os.path.join(os.getenv('OUTPUT_DIR'), f'multiworker_{datetime.now().strftime("%Y%m%d-%H%M%S")}')
+
+    cluster = [f'localhost:{port}' for port in find_free_ports(num_workers)]
+    ctx = mp.get_context('spawn') # a fresh interpreter for every TF runtime
+    workers = [
+        ctx.Process(target=run_worker, args=(i, cluster, entry, cpus, kwargs), name=f'tcpm_worker_{i}')
+        for i, cpus in enumerate(split_cpus(num_workers))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Workers {failed} exited with a non-zero code.')
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    launch_local_workers('run_nn_regression:run_bert_meta_regression_tfmodel', num_workers=2)
+    # launch_local_workers('run_nn_classification:finetune_tcpm_as_tfmodel', num_workers=2, run_dir_arg='ckpt_dir')
@@ -0,0 +1,218 @@
+""" Random search of the sequential neural network regressor hyper parameters
+    with parallel trials and pruning of the poor ones.
+
+    The trials are trained rung by rung on a growing budget of epochs (with early stopping inside every rung),
+    after each rung the poor trials are pruned, either the ones worse than the median score of the rung
+    or all but the top `1 / eta` (successive halving), and only the others continue to the next rung.
+"""
+import os
+import json
+import math
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from sklearn.preprocessing import StandardScaler, Normalizer
+from sklearn.model_selection import ParameterSampler, train_test_split
+from sklearn.metrics import mean_absolute_error
+
+from tc_data import TopCoder
+from final_model_selection import mre, tfmre, build_sequential_neural_network, init_nn_fold_worker
+from imbalanced_regression_metrics import PrecisionRecallFscoreForRegression
+
+NN_PARAM_DISTRIBUTIONS = {
+    'num_hidden_layers': [1, 2, 3, 4, 8],
+    'dimension': [64, 128, 256, 512, 1024],
+    'learning_rate': [1e-4, 5e-4, 1e-3, 1.5e-3],
+    'batch_size': [16, 32, 64],
+}
+
+TARGET_METRIC_ARGS = { # same domain parameters as `boosting_learn`
+    'avg_score': dict(tE=0.6, tL=3, c=90, extreme='low', decay=0.1),
+    'number_of_registration': dict(tE=0.6, tL=8, c=30, extreme='high'),
+    'sub_reg_ratio': dict(tE=0.6, tL=0.07, c=0.25, extreme='high'),
+}
+
+def run_nn_trial(params: dict, X_train, y_train, X_val, y_val, epochs, ckpt_prefix, initial_epoch=0, patience=5, metric_args=None):
+    """ Train one trial up to `epochs` and score it on the validation set.
+        The model and the optimizer state are saved to `ckpt_prefix`, and restored from it when resuming at `initial_epoch` > 0,
+        so that a trial trained rung by rung is the same as trained straight through.
+
+        Return a dict of the scores and whether the trial stopped early.
+    """
+    model = build_sequential_neural_network(params['num_hidden_layers'], params['dimension'], input_shape=X_train.shape[1])
+    optimizer = tf.keras.optimizers.RMSprop(params['learning_rate'])
+    model.compile(
+        optimizer=optimizer,
+        loss='mse',
+        metrics=['mse', 'mae', tfmre],
+    )
+    ckpt = tf.train.Checkpoint(model=model, optimizer=optimizer)
+    if initial_epoch > 0:
+        ckpt.restore(ckpt_prefix) # the optimizer slots are restored when they are created on the first step
+
+    escb = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience)
+    model.fit(
+        X_train,
+        y_train,
+        epochs=epochs,
+        initial_epoch=initial_epoch,
+        validation_data=(X_val, y_val),
+        batch_size=params['batch_size'],
+        callbacks=[escb],
+        verbose=0,
+    )
+
+    y_p = model.predict(X_val).reshape(-1)
+    scores = {'mae': mean_absolute_error(y_val, y_p), 'mre': mre(y_val, y_p)}
+    if metric_args is not None:
+        prf = PrecisionRecallFscoreForRegression(**metric_args)
+        scores.update(precision=prf.precision(y_val, y_p), recall=prf.recall(y_val, y_p), fscore=prf.fscore(y_val, y_p))
+
+    ckpt.write(ckpt_prefix)
+    return {'scores': scores, 'stopped': escb.stopped_epoch > 0}
+
+def prune_trials(rung_scores: dict, pruner='halving', eta=3):
+    """ Return the ids of the trials that continue to the next rung from their score (lower is better) of this rung."""
+    if pruner == 'median':
+        median = np.median(list(rung_scores.values()))
+        return {trial_id for trial_id, score in rung_scores.items() if score <= median}
+    if pruner == 'halving':
+        num_kept = max(1, math.ceil(len(rung_scores) / eta))
+        return set(sorted(rung_scores, key=rung_scores.get)[:num_kept])
+
+    raise ValueError(f'`pruner` should be either "median" or "halving", received {pruner}')
+
+def search_sequential_nn(
+    X_train,
+    y_train,
+    X_val,
+    y_val,
+    param_distributions=None,
+    n_iter=20,
+    rungs=(20, 100, 500),
+    pruner='halving',
+    eta=3,
+    refit='mre',
+    metric_args=None,
+    n_jobs=-1,
+    random_state=42,
+):
+    """ Random search of `build_sequential_neural_network` regressors.
+
+        :param rungs: cumulative number of epochs the surviving trials are trained to after each rung
+        :param pruner: "median" or "halving" (successive halving keeping the top `1 / eta` of each rung)
+        :param refit: score that selects the best trial, "mae", "mre" or "fscore" (needs `metric_args`)
+        :param metric_args: parameters of `PrecisionRecallFscoreForRegression` to also score the imbalanced metrics
+        :param n_jobs: number of trials trained in parallel processes, -1 for one per core
+
+        Return the `pd.DataFrame` of the trials, with the params, the scores of the last rung the trial reached,
+        that rung and whether the trial was pruned. The trials not pruned either completed the last rung or stopped early.
+    """
+    refit_scores = ('mae', 'mre', 'fscore') if metric_args is not None else ('mae', 'mre')
+    if refit not in refit_scores:
+        raise ValueError(f'`refit` should be one of {refit_scores} (fscore needs `metric_args`), received {refit}')
+
+    sign = -1 if refit == 'fscore' else 1 # lower is better for the pruning
+    trials = list(ParameterSampler(param_distributions or NN_PARAM_DISTRIBUTIONS, n_iter=n_iter, random_state=random_state))
+    state = [{'epoch': 0, 'scores': None, 'rung': None, 'stopped': False, 'pruned': False} for _ in trials]
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    threads_per_job = max(1, os.cpu_count() // n_jobs)
+
+    with tempfile.TemporaryDirectory(prefix='nn_search_') as ckpt_dir, ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=mp.get_context('spawn'),
+        initializer=init_nn_fold_worker,
+        initargs=(threads_per_job, 1),
+    ) as executor:
+        running = list(range(len(trials)))
+        for rung, rung_epochs in enumerate(rungs):
+            futures = {
+                trial_id: executor.submit(
+                    run_nn_trial,
+                    trials[trial_id],
+                    X_train,
+                    y_train,
+                    X_val,
+                    y_val,
+                    epochs=rung_epochs,
+                    ckpt_prefix=os.path.join(ckpt_dir, f'trial_{trial_id}'),
+                    initial_epoch=state[trial_id]['epoch'],
+                    metric_args=metric_args,
+                )
+                for trial_id in running
+            }
+            for trial_id, future in futures.items():
+                res = future.result()
+                state[trial_id].update(epoch=rung_epochs, scores=res['scores'], rung=rung, stopped=res['stopped'])
+
+            print(f'Rung {rung} ({rung_epochs} epochs): {len(running)} trials, best {refit} {min(sign * state[i]["scores"][refit] for i in running) * sign}')
+
+            if rung == len(rungs) - 1:
+                break
+
+            kept = prune_trials({trial_id: sign * state[trial_id]['scores'][refit] for trial_id in running}, pruner, eta)
+            for trial_id in running:
+                state[trial_id]['pruned'] = trial_id not in kept
+            running = [trial_id for trial_id in running if trial_id in kept and not state[trial_id]['stopped']]
+            if not running:
+                break
+
+    return pd.DataFrame([
+        {**params, **trial_state['scores'], 'rung': trial_state['rung'], 'epochs': trial_state['epoch'], 'pruned': trial_state['pruned']}
+        for params, trial_state in zip(trials, state)
+    ])
+
+def random_search_sequential_nn(n_iter=20, pruner='halving', refit='mre', n_jobs=-1):
+    """ Perform the random search of the sequential neural network for every target,
+        the result is written into `result/random_search_res` like the other regressors.
+    """
+    tc = TopCoder()
+    rs_path = os.path.join(os.curdir, 'result', 'random_search_res')
+    X_with_prize, X_without_prize, Y = tc.build_multi_target_dataset()
+
+    for target in tc.final_targets:
+        rs_res_path = os.path.join(rs_path, f'{target}_SequentialNN_rs.json')
+        if os.path.isfile(rs_res_path):
+            continue
+        print(f'{target} | Random Searching....')
+
+        X = X_without_prize if target == 'total_prize' else X_with_prize
+        X_train, X_test, y_train, y_test = train_test_split(X.to_numpy(), Y[target].to_numpy(), test_size=0.3, random_state=42)
+        X_fit, X_val, y_fit, y_val = train_test_split(X_train, y_train, test_size=0.2, random_state=42)
+
+        scaler = StandardScaler().fit(X_fit)
+        normer = Normalizer().fit(X_fit)
+        X_fit, X_val = normer.transform(scaler.transform(X_fit)), normer.transform(scaler.transform(X_val))
+
+        trials_df = search_sequential_nn(
+            X_fit,
+            y_fit,
+            X_val,
+            y_val,
+            n_iter=n_iter,
+            pruner=pruner,
+            refit=refit,
+            metric_args=TARGET_METRIC_ARGS.get(target),
+            n_jobs=n_jobs,
+        )
+        finalists = trials_df.loc[~trials_df['pruned']]
+        best = finalists[refit].idxmax() if refit == 'fscore' else finalists[refit].idxmin()
+
+        rs_res = {
+            'regressor': 'SequentialNN',
+            'best_params': {k: trials_df.loc[best, k].item() for k in NN_PARAM_DISTRIBUTIONS},
+            'best_score_in_rs': float(trials_df.loc[best, refit] if refit == 'fscore' else -trials_df.loc[best, refit]), # greater is better like the sklearn scorers
+        }
+
+        with open(rs_res_path, 'w') as f:
+            json.dump(rs_res, f, indent=4)
+        trials_df.to_json(os.path.join(rs_path, f'{target}_SequentialNN_rs_trials.json'), orient='index', indent=4)
+
+if __name__ == "__main__":
+    random_search_sequential_nn()
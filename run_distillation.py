@@ -0,0 +1,146 @@
+""" Distill the DistilBERT encoder of TCPM regression model into a lightweight student encoder
+    for high-throughput pricing of the whole challenge backlog.
+"""
+
+import os
+import json
+import time
+import glob
+import hashlib
+from pprint import pprint
+from datetime import datetime
+from dotenv import load_dotenv
+
+import numpy as np
+import pandas as pd
+
+import tensorflow as tf
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    TFDistilBertModel,
+)
+
+from tc_data import TopCoder
+from input_pipeline import cast_encoded_text, bucket_by_token_length
+from model_tcpm_distilbert import (
+    build_tcpm_model_distilbert_regression,
+    build_tcpm_model_student_regression,
+    build_student_text_encoder,
+    cache_cls_embeddings,
+)
+from run_nn_regression import mre
+
+load_dotenv()
+
+def benchmark_throughput(model: tf.keras.Model, features: dict, batch_size=64, num_batches=20):
+    """ Measure the CPU inference throughput of a model in examples/sec.
+        The first batch is used to warm up (trace) the model and is not timed.
+    """
+    @tf.function
+    def predict(batch):
+        return model(batch, training=False)
+
+    batches = [
+        {k: tf.constant(arr[start:start + batch_size]) for k, arr in features.items()}
+        for start in range(0, min(len(features['meta_input']), batch_size * (num_batches + 1)), batch_size)
+    ]
+    predict(batches[0])
+
+    num_examples = 0
+    start = time.perf_counter()
+    for batch in batches[1:]:
+        predict(batch)
+        num_examples += len(batch['meta_input'])
+
+    return num_examples / (time.perf_counter() - start)
+
+def weights_fingerprint(weights_fn):
+    """ SHA-1 of the content of saved weights, a `.h5` file or the files of a TF checkpoint prefix."""
+    weights_files = [weights_fn] if os.path.isfile(weights_fn) else sorted(glob.glob(f'{glob.escape(weights_fn)}.*'))
+    if not weights_files:
+        raise FileNotFoundError(f'No weights found at {weights_fn}')
+
+    hasher = hashlib.sha1()
+    for fn in weights_files:
+        with open(fn, 'rb') as fread:
+            for chunk in iter(lambda: fread.read(1 << 20), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()[:20]
+
+def run_distillation(epochs=20, head_epochs=12, teacher_weights=None):
+    """ Distill the student encoder to reproduce the teacher `[CLS]` embeddings.
+
+        The regression head is trained on the teacher embeddings (or taken from the trained teacher
+        when `teacher_weights` of a `build_tcpm_model_distilbert_regression` model is given),
+        then put on top of the student encoder as a drop-in TCPM regression model.
+    """
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    log_dir = os.path.join(os.getenv('OUTPUT_DIR'), f'distillation_{timestamp}')
+    os.makedirs(log_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
+    config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=1)
+    distilebert_model = TFDistilBertModel.from_pretrained(os.getenv('MODEL_NAME'), config=config)
+    teacher = build_tcpm_model_distilbert_regression(distilebert_model)
+    if teacher_weights is not None:
+        teacher.load_weights(teacher_weights)
+
+    tc = TopCoder()
+    req = tc.get_filtered_requirements()
+    encoded_text = tc.load_bert_encoding_cache(tokenizer, req['requirements'])
+    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True, dtype=np.float32)
+    target = tc.get_target(dtype=np.float32)
+
+    # the cache of a fine-tuned teacher is keyed by the content of its weights, so different teachers never share it
+    teacher_name = weights_fingerprint(teacher_weights) if teacher_weights else os.getenv('MODEL_NAME').replace('/', '_')
+    cls_fn = os.path.join(tc.get_bert_encoding_cache_path(tokenizer, req['requirements']), f'cls_embedding_{teacher_name}.npy')
+    cls_embedding = cache_cls_embeddings(distilebert_model, encoded_text, cls_fn)
+
+    split = int((4 / 5) * len(target))
+
+    # Stage 1: embedding distillation, the student learns to reproduce the teacher [CLS] embeddings
+    student_encoder = build_student_text_encoder(vocab_size=tokenizer.vocab_size, output_dim=config.dim)
+    distill_ds = tf.data.Dataset.from_tensor_slices((dict(**encoded_text), cls_embedding)).map(cast_encoded_text)
+    distill_ds = distill_ds.shuffle(len(target), seed=42, reshuffle_each_iteration=False)
+    train_ds = bucket_by_token_length(distill_ds.take(split), 32).prefetch(tf.data.experimental.AUTOTUNE)
+    test_ds = bucket_by_token_length(distill_ds.skip(split), 32)
+
+    student_encoder.compile(optimizer=tf.keras.optimizers.Adam(1e-3), loss='mse', metrics=[tf.keras.metrics.CosineSimilarity()])
+    distill_history = student_encoder.fit(train_ds, epochs=epochs, validation_data=test_ds)
+
+    # Stage 2: the head on top of the teacher embeddings is reused on top of the student encoder
+    head = teacher.get_layer('tcpm_regression_head')
+    if teacher_weights is None:
+        head_ds = tf.data.Dataset.from_tensor_slices((dict(cls_embedding=cls_embedding, meta_input=metadata), target))
+        head_ds = head_ds.shuffle(len(target), seed=42, reshuffle_each_iteration=False)
+        head.compile(optimizer=tf.keras.optimizers.Adam(2e-4), loss='mse', metrics=['mae', 'mse', mre])
+        head.fit(head_ds.take(split).batch(16), epochs=head_epochs)
+
+    student = build_tcpm_model_student_regression(student_encoder, head=head)
+    student.compile(loss='mse', metrics=['mae', 'mse', mre])
+    teacher.compile(loss='mse', metrics=['mae', 'mse', mre])
+
+    eval_ds = tf.data.Dataset.from_tensor_slices((dict(**encoded_text, meta_input=metadata), target)).map(cast_encoded_text)
+    eval_ds = bucket_by_token_length(eval_ds.shuffle(len(target), seed=42, reshuffle_each_iteration=False).skip(split), 8)
+    result = {
+        'student': student.evaluate(eval_ds, return_dict=True),
+        'teacher': teacher.evaluate(eval_ds, return_dict=True),
+    }
+
+    features = {k: np.asarray(arr, dtype=np.int32) for k, arr in encoded_text.items()}
+    features['meta_input'] = metadata
+    result['examples_per_sec'] = {
+        'student': benchmark_throughput(student, features),
+        'teacher': benchmark_throughput(teacher, features),
+    }
+    pprint(result)
+
+    student_encoder.save_weights(os.path.join(log_dir, 'student_encoder.h5'))
+    student.save_weights(os.path.join(log_dir, 'student_regression.h5'))
+    pd.DataFrame(distill_history.history).to_json(os.path.join(log_dir, 'train_history.json'), orient='index', indent=4)
+    with open(os.path.join(log_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=4)
+
+if __name__ == "__main__":
+    run_distillation()
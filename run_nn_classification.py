@@ -10,6 +10,7 @@ import json
 import re
 from pprint import pprint
 from dataclasses import dataclass, field
+from datetime import datetime
 from dotenv import load_dotenv
 from typing import Union
 
@@ -23,13 +24,16 @@ from transformers import (
     TFAutoModel,
     TFAutoModelForSequenceClassification,
     TFBertPreTrainedModel,
-    TFTrainer,
     TFTrainingArguments,
 )
 from sklearn.metrics import precision_recall_fscore_support
 
 from tc_data import TopCoder
-from model_tcpm_distilbert import TCPMDistilBertClassification, build_tcpm_model_distilbert_classification
+from input_pipeline import cast_encoded_text, bucket_by_token_length, split_train_val_test
+from training_harness import fit_with_checkpoints
+from multiworker_launcher import is_chief
+from training_instrumentation import InstrumentedTFTrainer
+from model_tcpm_distilbert import TCPMDistilBertClassification, TCPMStepFunctions, build_tcpm_model_distilbert_classification
 
 load_dotenv()
 # MODEL_NAME = os.getenv('MODEL_NAME')
@@ -38,11 +42,14 @@ load_dotenv()
 TRAIN_BATCH_SIZE = 16
 TEST_BATCH_SIZE = 4
 
-def build_dataset(tokenizer):
-    """ Build td.data.Dataset out of text and prize range."""
+def build_dataset(tokenizer, token_budget=None):
+    """ Build td.data.Dataset out of text and prize range.
+
+        :param token_budget: encode only the most valuable requirement sections packed into this many tokens
+    """
     # Load TopCoder data
     tc = TopCoder()
-    tc_req = tc.get_filtered_requirements()
+    tc_req = tc.get_budgeted_requirements(tokenizer, token_budget) if token_budget else tc.get_filtered_requirements()
     tc_meta = tc.get_filtered_challenge_info()
     metadata_cols = ['number_of_platforms', 'number_of_technologies', 'project_id', 'challenge_duration']
 
@@ -61,32 +68,20 @@ def build_dataset(tokenizer):
     dataset_size = len(req_prz_df)
     num_labels = len(req_prz_df['prize_cat'].unique()) + 1
 
-    # batched encode the str to `input_ids` and `attention_mask`
-    batched_encoded = tokenizer(req_prz_df['requirements'].to_list(), padding='max_length', truncation=True)
-
-    # List((enccoded_str, metadata, prize_cat),...)
-    features = [(
-        {k: batched_encoded[k][i] for k in batched_encoded},
-        req_prz_df.reindex(metadata_cols, axis=1).iloc[i],
-        req_prz_df['prize_cat'].iloc[i]
-        ) for i in range(len(req_prz_df))]
-
-    def gen():
-        """ generator used in `tf.data.Dataset.from_generator`."""
-        for encoded_str, metadata, label in features:
-            yield dict(**encoded_str, meta_input=metadata), label # NOTE: it's import the key if named "meta_input" to match the input_layer's name in the model
-
-    dataset = tf.data.Dataset.from_generator(
-        gen,
-        (
-            dict(**{k: tf.int32 for k in batched_encoded}, meta_input=tf.float32),
-            tf.int32
-            ),
-        (
-            dict(**{k: tf.TensorShape([512]) for k in batched_encoded}, meta_input=tf.TensorShape([4])),
-            tf.TensorShape([])
-            )
+    # batched encode the str to `input_ids` and `attention_mask`, loaded from the tokenization cache
+    batched_encoded = tc.load_bert_encoding_cache(tokenizer, req_prz_df['requirements'], padding='max_length', max_length=token_budget)
+
+    # contiguous arrays of the whole dataset, no per-row python objects
+    # NOTE: it's important the key is named "meta_input" to match the input_layer's name in the model
+    features = dict(
+        **batched_encoded,
+        meta_input=req_prz_df.reindex(metadata_cols, axis=1).to_numpy(dtype=np.float32),
     )
+    labels = req_prz_df['prize_cat'].to_numpy(dtype=np.int32)
+
+    dataset = tf.data.Dataset.from_tensor_slices((features, labels))\
+        .map(cast_encoded_text, num_parallel_calls=tf.data.experimental.AUTOTUNE)\
+        .cache()
 
     return (
         dataset,
@@ -145,7 +140,7 @@ def finetune_with_tftrainer():
     train_data = dataset.take(train_size)#.batch(TRAIN_BATCH_SIZE)
     test_data = dataset.skip(train_size)#.batch(TEST_BATCH_SIZE)
 
-    trainer = TFTrainer(
+    trainer = InstrumentedTFTrainer(
         model=model,
         args=training_args,
         train_dataset=train_data,
@@ -184,45 +179,98 @@ def finetune_with_tftrainer():
     with open(os.path.join(os.getenv('OUTPUT_DIR'), 'eval_results.json'), 'w') as fwrite:
         json.dump(result, fwrite, indent=4)
 
-def finetune_tcpm_as_tfmodel():
-    """ Fine tune the subclass model as a tf model"""
+def finetune_tcpm_as_tfmodel(ckpt_dir=None, patience=2, strategy=None):
+    """ Fine tune the subclass model as a tf model
+
+        :param ckpt_dir: checkpoint directory, pass the directory of an interrupted run to resume it,
+        a new timestamped directory is used by default
+        :param patience: number of epochs without improvement of the validation loss before stopping early
+        :param strategy: `tf.distribute` strategy to build the model under, see `multiworker_launcher`
+    """
+    strategy = strategy or tf.distribute.get_strategy()
     tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
 
     # Get data for fine-tuning
     dataset, dataset_size, num_labels = build_dataset(tokenizer)
 
+    config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=num_labels)
+    with strategy.scope():
+        model = TCPMDistilBertClassification.from_pretrained(os.getenv('MODEL_NAME'), config=config)
+
+    # shuffle and split train/test tasks manuanly, the split is kept the same across runs to resume training
+    dataset = dataset.shuffle(dataset_size, seed=42, reshuffle_each_iteration=False)
+    train_data, val_data, test_data = split_train_val_test(dataset, dataset_size)
+
+    train_data = bucket_by_token_length(train_data.shuffle(dataset_size, seed=42), TRAIN_BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
+    val_data = bucket_by_token_length(val_data, TEST_BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
+    test_data = bucket_by_token_length(test_data, TEST_BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
+
+    with strategy.scope():
+        optimizer = tf.keras.optimizers.Adam(learning_rate=3e-5)
+        loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+        metrics = [tf.keras.metrics.SparseCategoricalCrossentropy(from_logits=True), 'accuracy']
+        model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
+
+    ckpt_dir = ckpt_dir or os.path.join(os.getenv('OUTPUT_DIR'), 'tcpm_classification_checkpoints', datetime.now().strftime('%Y%m%d-%H%M%S'))
+    history_df = fit_with_checkpoints(model, train_data, ckpt_dir, epochs=4, validation_data=val_data, patience=patience)
+    result = model.evaluate(test_data, return_dict=True)
+    if not is_chief():
+        return
+
+    print(history_df)
+    pprint(result)
+    with open(os.path.join(ckpt_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=4)
+
+def finetune_tcpm_with_step_functions(epochs=4, experimental_compile=False):
+    """ Fine tune the subclass model with graph compiled train/predict steps.
+        The steps have fixed input signatures, the trace count is reported after every epoch
+        to confirm that the steady state steps never retrace.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
+
+    dataset, dataset_size, num_labels = build_dataset(tokenizer)
+
     config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=num_labels)
     model = TCPMDistilBertClassification.from_pretrained(os.getenv('MODEL_NAME'), config=config)
 
-    # shuffle and split train/test tasks manuanly
-    dataset = dataset.shuffle(dataset_size)
+    dataset = dataset.shuffle(dataset_size, seed=42, reshuffle_each_iteration=False)
     train_size = int(dataset_size * (4 / 5))
-    # test_size = dataset_size - train_size # didn't use so commented out.
-
-    train_data = dataset.take(train_size).batch(TRAIN_BATCH_SIZE)
-    test_data = dataset.skip(train_size).batch(TEST_BATCH_SIZE)
+    train_data = bucket_by_token_length(dataset.take(train_size), TRAIN_BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
+    test_data = bucket_by_token_length(dataset.skip(train_size), TEST_BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
+
+    steps = TCPMStepFunctions(
+        model,
+        optimizer=tf.keras.optimizers.Adam(learning_rate=3e-5),
+        loss_fn=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        meta_dim=model.meta_dim,
+        label_dtype=tf.int32,
+        experimental_compile=experimental_compile,
+    )
 
-    optimizer = tf.keras.optimizers.Adam(learning_rate=3e-5)
-    loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-    metrics = [tf.keras.metrics.SparseCategoricalCrossentropy(from_logits=True), 'accuracy']
-    model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
+    for epoch in range(epochs):
+        train_loss = tf.keras.metrics.Mean()
+        for features, labels in train_data:
+            train_loss.update_state(steps.train_step(features, labels))
+        print(f'Epoch {epoch + 1}/{epochs} - loss: {train_loss.result().numpy():.4f} - traces: {steps.trace_count}')
 
-    model.fit(train_data, epochs=4)
-    result = model.evaluate(test_data)
-    print(result)
+    accuracy = tf.keras.metrics.SparseCategoricalAccuracy()
+    for features, labels in test_data:
+        accuracy.update_state(labels, steps.predict_step(features))
+    print(f'Test accuracy: {accuracy.result().numpy():.4f} - traces: {steps.trace_count}')
 
-def finetune_tf_function():
+def finetune_tf_function(token_budget=None):
     """ Fine tune functional api."""
     tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
 
     # Get data for fine-tuning
-    dataset, dataset_size, num_labels = build_dataset(tokenizer)
+    dataset, dataset_size, num_labels = build_dataset(tokenizer, token_budget)
     # shuffle and split train/test tasks manuanly
     dataset = dataset.shuffle(dataset_size)
     train_size = int(dataset_size * (4 / 5))
     # test_size = dataset_size - train_size # didn't use so commented out.
-    train_data = dataset.take(train_size).batch(TRAIN_BATCH_SIZE)
-    test_data = dataset.skip(train_size).batch(TEST_BATCH_SIZE)
+    train_data = bucket_by_token_length(dataset.take(train_size), TRAIN_BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
+    test_data = bucket_by_token_length(dataset.skip(train_size), TEST_BATCH_SIZE).prefetch(tf.data.experimental.AUTOTUNE)
 
     print('Sample training data:')
     for i in train_data.take(2):
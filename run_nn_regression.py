@@ -19,13 +19,24 @@ from transformers import (
     TFAutoModel,
     TFDistilBertModel,
     TFDistilBertForSequenceClassification,
-    TFTrainer,
     TFTrainingArguments
 )
 from sklearn.metrics import max_error, mean_absolute_error, median_absolute_error, mean_squared_error, r2_score
 
 from tc_data import TopCoder
-from model_tcpm_distilbert import build_tcpm_model_distilbert_regression, TCPMDistilBertRegression
+from input_pipeline import cast_encoded_text, bucket_by_token_length, trim_batch_padding, memmap_dataset, split_train_val_test
+from export_tflite import export_tflite_model, TFLitePredictor, compare_with_original
+from training_harness import fit_with_checkpoints
+from multiworker_launcher import is_chief
+from training_instrumentation import TrainingInstrumentation, InstrumentedTFTrainer
+from model_tcpm_distilbert import (
+    build_tcpm_model_distilbert_regression,
+    build_tcpm_regression_head,
+    cache_cls_embeddings,
+    cache_lower_block_activations,
+    TCPMDistilBertRegression,
+    TCPMPartialDistilBertRegression,
+)
 
 load_dotenv()
 
@@ -79,12 +90,12 @@ def run_bert_regression_trainer():
     print(training_args)
 
     tc = TopCoder()
-    encoded_text = tc.get_bert_encoded_txt_features(tokenizer)
-    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True)
-    target = tc.get_target()
+    encoded_text = tc.get_bert_encoded_txt_features(tokenizer, use_cache=True)
+    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True, dtype=np.float32)
+    target = tc.get_target(dtype=np.float32)
 
     split = int((4 / 5) * len(target))
-    dataset = tf.data.Dataset.from_tensor_slices((dict(**encoded_text, meta_input=metadata), target))
+    dataset = tf.data.Dataset.from_tensor_slices((dict(**encoded_text, meta_input=metadata), target)).map(cast_encoded_text)
     dataset = dataset.shuffle(len(target))
     train_ds, test_ds = dataset.take(split), dataset.skip(split)
 
@@ -95,7 +106,7 @@ def run_bert_regression_trainer():
     for el in test_ds.take(3):
         pprint(el)
 
-    trainer = TFTrainer(
+    trainer = InstrumentedTFTrainer(
         model=model,
         args=training_args,
         train_dataset=train_ds,
@@ -113,14 +124,21 @@ def run_bert_regression_trainer():
     with open(os.path.join(log_dir, 'eval_results.json'), 'w') as fwrite:
         json.dump(result, fwrite, indent=4)
 
-def run_bert_regression_tfmodel():
-    """ Run BERT for regression as a tfmodel."""
+def run_bert_regression_tfmodel(log_dir=None, patience=3, strategy=None):
+    """ Run BERT for regression as a tfmodel.
+
+        :param log_dir: output directory of the run, pass the directory of an interrupted run to resume it
+        :param patience: number of epochs without improvement of the validation loss before stopping early
+        :param strategy: `tf.distribute` strategy to build the model under, see `multiworker_launcher`
+    """
     print('START TRAINNING FOR REGRESSION')
+    strategy = strategy or tf.distribute.get_strategy()
 
     # Initialize BERT model
     tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
     config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=1)
-    model = TFDistilBertForSequenceClassification.from_pretrained(os.getenv('MODEL_NAME'), config=config)
+    with strategy.scope():
+        model = TFDistilBertForSequenceClassification.from_pretrained(os.getenv('MODEL_NAME'), config=config)
 
     print('\nModel Config:')
     print(config)
@@ -129,16 +147,17 @@ def run_bert_regression_tfmodel():
 
     # Preparing training data
     tc = TopCoder()
-    encoded_text = tc.get_bert_encoded_txt_features(tokenizer)
-    target = tc.get_target()
+    encoded_text = tc.get_bert_encoded_txt_features(tokenizer, use_cache=True)
+    target = tc.get_target(dtype=np.float32)
 
     print(f'\nSize of dataset: {len(target)}')
 
-    dataset = tf.data.Dataset.from_tensor_slices((encoded_text, target))
-    dataset = dataset.shuffle(len(target))
-    train_ds, test_ds = dataset.take(int((4 / 5) * len(target))), dataset.skip(int((4 / 5) * len(target)))
-    train_ds = train_ds.batch(16)
-    test_ds = test_ds.batch(8)
+    dataset = tf.data.Dataset.from_tensor_slices((encoded_text, target)).map(cast_encoded_text)
+    dataset = dataset.shuffle(len(target), seed=42, reshuffle_each_iteration=False) # same split on resume
+    train_ds, val_ds, test_ds = split_train_val_test(dataset, len(target))
+    train_ds = bucket_by_token_length(train_ds.shuffle(len(target), seed=42), 16).prefetch(tf.data.experimental.AUTOTUNE)
+    val_ds = bucket_by_token_length(val_ds, 8).prefetch(tf.data.experimental.AUTOTUNE)
+    test_ds = bucket_by_token_length(test_ds, 8).prefetch(tf.data.experimental.AUTOTUNE)
 
     print('\nTrain dataset samples:')
     for el in train_ds.take(3):
@@ -148,17 +167,23 @@ def run_bert_regression_tfmodel():
         pprint(el)
 
     # TF-Fashioned training model
-    log_dir = os.path.join(os.getenv('OUTPUT_DIR'), 'logs', datetime.now().strftime('%Y%m%d-%H%M%S'))
+    log_dir = log_dir or os.path.join(os.getenv('OUTPUT_DIR'), 'logs', datetime.now().strftime('%Y%m%d-%H%M%S'))
     tensorboard_cb = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1) # fancy visulization :)
-    model.compile(
-        optimizer=tf.keras.optimizers.Adam(learning_rate=2e-6),
-        loss='mse',
-        metrics=['mae', 'mse', mre]
-    )
-    history = model.fit(
+    instrumentation_cb = TrainingInstrumentation(log_dir, train_ds=train_ds)
+    with strategy.scope():
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate=2e-6),
+            loss='mse',
+            metrics=['mae', 'mse', mre]
+        )
+    history_df = fit_with_checkpoints(
+        model,
         train_ds,
+        ckpt_dir=os.path.join(log_dir, 'checkpoints'),
         epochs=6,
-        callbacks=[tensorboard_cb]
+        validation_data=val_ds,
+        patience=patience,
+        callbacks=[tensorboard_cb, instrumentation_cb] if is_chief() else None
     )
     result = model.evaluate(
         test_ds,
@@ -166,36 +191,46 @@ def run_bert_regression_tfmodel():
     )
 
     pprint(result)
+    if not is_chief():
+        return
 
-    history_df = pd.DataFrame(history.history)
     history_df.to_json(os.path.join(log_dir, 'train_history.json'), orient='index', indent=4)
     with open(os.path.join(log_dir, 'result.json'), 'w') as f:
         json.dump(result, f, indent=4)
 
-def run_bert_meta_regression_tfmodel():
-    """ Run self defined combined model."""
+def run_bert_meta_regression_tfmodel(export_tflite=False, token_budget=None, log_dir=None, patience=3, strategy=None):
+    """ Run self defined combined model.
+
+        :param export_tflite: export the trained model as a quantized TFLite model
+        and write an accuracy/latency comparison on the test split next to the training history
+        :param token_budget: encode only the most valuable requirement sections packed into this many tokens
+        :param log_dir: output directory of the run, pass the directory of an interrupted run to resume it
+        :param patience: number of epochs without improvement of the validation loss before stopping early
+        :param strategy: `tf.distribute` strategy to build the model under, see `multiworker_launcher`
+    """
+    strategy = strategy or tf.distribute.get_strategy()
     timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-    log_dir = os.path.join(os.getenv('OUTPUT_DIR'), timestamp)
+    log_dir = log_dir or os.path.join(os.getenv('OUTPUT_DIR'), timestamp)
     model_plot = f'regression_model_{timestamp}.png'
 
     tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
     config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=1)
-    distilebert_model = TFDistilBertModel.from_pretrained(os.getenv('MODEL_NAME'), config=config)
 
     print(config, tokenizer, sep='\n')
     # tf.keras.utils.plot_model(distilebert_model, to_file=model_plot, show_shapes=True)
 
     tc = TopCoder()
-    encoded_text = tc.get_bert_encoded_txt_features(tokenizer)
-    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True)
-    target = tc.get_target()
+    encoded_text = tc.get_bert_encoded_txt_features(tokenizer, use_cache=True, token_budget=token_budget)
+    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True, dtype=np.float32)
+    target = tc.get_target(dtype=np.float32)
 
-    split = int((4 / 5) * len(target))
-    dataset = tf.data.Dataset.from_tensor_slices((dict(**encoded_text, meta_input=metadata), target))
-    dataset = dataset.shuffle(len(target))
-    train_ds, test_ds = dataset.take(split).batch(16), dataset.skip(split).batch(8)
+    dataset = tf.data.Dataset.from_tensor_slices((dict(**encoded_text, meta_input=metadata), target)).map(cast_encoded_text)
+    dataset = dataset.shuffle(len(target), seed=42, reshuffle_each_iteration=False) # same split on resume
+    train_ds, val_ds, test_ds = split_train_val_test(dataset, len(target))
+    train_ds = bucket_by_token_length(train_ds.shuffle(len(target), seed=42), 16)
+    val_ds, test_ds = bucket_by_token_length(val_ds, 8), bucket_by_token_length(test_ds, 8)
 
-    print(train_ds, test_ds, sep='\n')
+    print(train_ds, val_ds, test_ds, sep='\n')
     # for i in train_ds.take(2):
     #     pprint(i)
     # print()
@@ -204,22 +239,146 @@ def run_bert_meta_regression_tfmodel():
 
     # model = TCPMDistilBertRegression.from_pretrained(os.getenv('MODEL_NAME'), config=config)
     tensorboard_cb = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
-    model = build_tcpm_model_distilbert_regression(distilebert_model)
+    instrumentation_cb = TrainingInstrumentation(log_dir, train_ds=train_ds)
+    with strategy.scope():
+        distilebert_model = TFDistilBertModel.from_pretrained(os.getenv('MODEL_NAME'), config=config)
+        model = build_tcpm_model_distilbert_regression(distilebert_model)
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(2e-6),
+            loss='mse',
+            metrics=['mae', 'mse', mre]
+        )
     model.summary()
-    model.compile(
-        optimizer=tf.keras.optimizers.Adam(2e-6),
-        loss='mse',
-        metrics=['mae', 'mse', mre]
-    )
-    history = model.fit(
+    history_df = fit_with_checkpoints(
+        model,
         train_ds,
+        ckpt_dir=os.path.join(log_dir, 'checkpoints'),
         epochs=12,
+        validation_data=val_ds,
+        patience=patience,
+        callbacks=[instrumentation_cb] if is_chief() else None,
     )
     result = model.evaluate(
         test_ds,
         return_dict=True,
     )
 
+    pprint(result)
+    if not is_chief():
+        return
+
+    if export_tflite:
+        tflite_fn = export_tflite_model(model, os.path.join(log_dir, 'tcpm_regression.tflite'), seq_len=encoded_text['input_ids'].shape[1], meta_dim=metadata.shape[1])
+        quantization_report = compare_with_original(model, TFLitePredictor(tflite_fn), test_ds, os.path.join(log_dir, 'quantization_report.json'))
+        pprint(quantization_report)
+
+    history_df.to_json(os.path.join(log_dir, 'train_history.json'), orient='index', indent=4)
+    with open(os.path.join(log_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=4)
+
+def run_bert_meta_regression_frozen_encoder(epochs=12, finetune_epochs=0):
+    """ Run the combined model with a frozen DistilBERT encoder.
+        The `[CLS]` embeddings are computed once and cached, only the regression head is trained on the cache.
+        When `finetune_epochs` > 0, the trained head is put on top of DistilBERT and the full model is fine-tuned.
+    """
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    log_dir = os.path.join(os.getenv('OUTPUT_DIR'), timestamp)
+    os.makedirs(log_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
+    config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=1)
+    distilebert_model = TFDistilBertModel.from_pretrained(os.getenv('MODEL_NAME'), config=config)
+
+    tc = TopCoder()
+    req = tc.get_filtered_requirements()
+    encoded_text = tc.load_bert_encoding_cache(tokenizer, req['requirements'])
+    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True, dtype=np.float32)
+    target = tc.get_target(dtype=np.float32)
+
+    cls_fn = os.path.join(
+        tc.get_bert_encoding_cache_path(tokenizer, req['requirements']),
+        'cls_embedding_{}.npy'.format(os.getenv('MODEL_NAME').replace('/', '_'))
+    )
+    cls_embedding = cache_cls_embeddings(distilebert_model, encoded_text, cls_fn)
+
+    split = int((4 / 5) * len(target))
+    dataset = tf.data.Dataset.from_tensor_slices((dict(cls_embedding=cls_embedding, meta_input=metadata), target))
+    dataset = dataset.shuffle(len(target), seed=42, reshuffle_each_iteration=False)
+    train_ds, test_ds = dataset.take(split).batch(16), dataset.skip(split).batch(8)
+
+    head = build_tcpm_regression_head(meta_dim=metadata.shape[1], dim=config.dim)
+    head.summary()
+    head.compile(
+        optimizer=tf.keras.optimizers.Adam(2e-4),
+        loss='mse',
+        metrics=['mae', 'mse', mre]
+    )
+    history = head.fit(train_ds, epochs=epochs)
+    result = head.evaluate(test_ds, return_dict=True)
+    pprint(result)
+
+    history_df = pd.DataFrame(history.history)
+
+    if finetune_epochs > 0:
+        # same seed and size as the cached dataset above so the train/test split is identical
+        full_dataset = tf.data.Dataset.from_tensor_slices((dict(**encoded_text, meta_input=metadata), target)).map(cast_encoded_text)
+        full_dataset = full_dataset.shuffle(len(target), seed=42, reshuffle_each_iteration=False)
+        train_ds, test_ds = bucket_by_token_length(full_dataset.take(split), 16), bucket_by_token_length(full_dataset.skip(split), 8)
+
+        model = build_tcpm_model_distilbert_regression(distilebert_model, head=head)
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(2e-6),
+            loss='mse',
+            metrics=['mae', 'mse', mre]
+        )
+        history = model.fit(train_ds, epochs=finetune_epochs)
+        result = model.evaluate(test_ds, return_dict=True)
+        pprint(result)
+
+        history_df = pd.concat([history_df, pd.DataFrame(history.history)], ignore_index=True)
+
+    history_df.to_json(os.path.join(log_dir, 'train_history.json'), orient='index', indent=4)
+    with open(os.path.join(log_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=4)
+
+def run_bert_meta_regression_partial_finetune(num_frozen_layers=4, epochs=12):
+    """ Run the combined model fine-tuning only the top `6 - num_frozen_layers` DistilBERT blocks and the head.
+        Output of the frozen bottom blocks is computed once per challenge and read from a float16 memory-mapped cache.
+    """
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    log_dir = os.path.join(os.getenv('OUTPUT_DIR'), timestamp)
+    os.makedirs(log_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(os.getenv('MODEL_NAME'))
+    config = AutoConfig.from_pretrained(os.getenv('MODEL_NAME'), num_labels=1)
+    distilebert_model = TFDistilBertModel.from_pretrained(os.getenv('MODEL_NAME'), config=config)
+
+    tc = TopCoder()
+    req = tc.get_filtered_requirements()
+    encoded_text = tc.load_bert_encoding_cache(tokenizer, req['requirements'])
+    metadata = tc.get_meta_data_features(encoded_tech=True, softmax_tech=True, dtype=np.float32)
+    target = tc.get_target(dtype=np.float32)
+
+    hidden_state_fn = os.path.join(
+        tc.get_bert_encoding_cache_path(tokenizer, req['requirements']),
+        'hidden_state_{}_frozen{}.npy'.format(os.getenv('MODEL_NAME').replace('/', '_'), num_frozen_layers)
+    )
+    hidden_state = cache_lower_block_activations(distilebert_model, encoded_text, num_frozen_layers, hidden_state_fn)
+
+    features = dict(hidden_state=hidden_state, attention_mask=encoded_text['attention_mask'], meta_input=metadata)
+    indices = np.random.RandomState(42).permutation(len(target))
+    split = int((4 / 5) * len(target))
+    train_ds = memmap_dataset(features, target, indices[:split], 16).map(trim_batch_padding).prefetch(tf.data.experimental.AUTOTUNE)
+    test_ds = memmap_dataset(features, target, indices[split:], 8, shuffle=False).map(trim_batch_padding)
+
+    model = TCPMPartialDistilBertRegression(distilebert_model, num_frozen_layers)
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(2e-6),
+        loss='mse',
+        metrics=['mae', 'mse', mre]
+    )
+    history = model.fit(train_ds, epochs=epochs)
+    result = model.evaluate(test_ds, return_dict=True)
     pprint(result)
 
     history_df = pd.DataFrame(history.history)
@@ -0,0 +1,236 @@
+""" Train many small sequential MLP regressors at once as one stacked model.
+
+    The members of a stack (folds of a K-Fold validation and/or (layers, dimension) configurations)
+    have the same number of hidden layers, every layer keeps the weights of all the members in one
+    `(num_members, input_dim, units)` tensor and is computed as a single batched matmul.
+    Members with a smaller dimension than the widest one mask their extra units, every member has
+    its own rows of training/validation data and stops early on its own by masking its loss,
+    so the training of each member is independent of the others.
+"""
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from sklearn.preprocessing import StandardScaler, Normalizer
+from sklearn.model_selection import KFold
+from sklearn.metrics import r2_score, mean_squared_error, mean_absolute_error
+
+from final_model_selection import mre
+
+class StackedDense(tf.keras.layers.Layer):
+    """ Dense layer of `num_members` independent members, maps `(num_members, batch, input_dim)`
+        to `(num_members, batch, units)`.
+
+        :param member_units: units of every member (<= `units`), the outputs beyond are masked to zero
+        :param member_input_units: effective input dimension of every member, used for the Glorot
+        initialization of each member as if it were a standalone `Dense` layer
+    """
+
+    def __init__(self, units, num_members, activation=None, member_units=None, member_input_units=None, **kwargs):
+        super().__init__(**kwargs)
+        self.units = units
+        self.num_members = num_members
+        self.activation = tf.keras.activations.get(activation)
+        self.member_units = np.full(num_members, units) if member_units is None else np.asarray(member_units)
+        self.member_input_units = member_input_units
+
+    def build(self, input_shape):
+        input_dim = int(input_shape[-1])
+        member_input_units = np.full(self.num_members, input_dim) if self.member_input_units is None else np.asarray(self.member_input_units)
+        limit = np.sqrt(6 / (member_input_units + self.member_units)).astype(np.float32)[:, None, None]
+
+        self.kernel = self.add_weight(
+            'kernel',
+            shape=(self.num_members, input_dim, self.units),
+            initializer=lambda shape, dtype=None: tf.random.uniform(shape, -1, 1, dtype=dtype) * limit,
+        )
+        self.bias = self.add_weight('bias', shape=(self.num_members, 1, self.units), initializer='zeros')
+        self.unit_mask = tf.constant((np.arange(self.units) < self.member_units[:, None]).astype(np.float32)[:, None, :])
+        super().build(input_shape)
+
+    def call(self, inputs):
+        outputs = self.activation(tf.einsum('kbi,kio->kbo', inputs, self.kernel) + self.bias)
+        return outputs * self.unit_mask
+
+class StackedMLP(tf.keras.Model):
+    """ `num_members` sequential MLP regressors of `num_hidden_layers` relu layers,
+        the same as `final_model_selection.build_sequential_neural_network` for every member.
+
+        :param member_dimensions: hidden dimension of every member
+    """
+
+    def __init__(self, num_hidden_layers, member_dimensions, input_dim, **kwargs):
+        super().__init__(**kwargs)
+        member_dimensions = np.asarray(member_dimensions)
+        num_members, dimension = len(member_dimensions), int(member_dimensions.max())
+
+        self.hidden_layers = [
+            StackedDense(
+                dimension,
+                num_members,
+                activation='relu',
+                member_units=member_dimensions,
+                member_input_units=np.full(num_members, input_dim) if i == 0 else member_dimensions,
+                name=f'layer_{i}',
+            )
+            for i in range(num_hidden_layers)
+        ]
+        self.reg = StackedDense(
+            1,
+            num_members,
+            member_input_units=member_dimensions if num_hidden_layers > 0 else None,
+            name='reg',
+        )
+
+    def call(self, inputs):
+        x = inputs
+        for layer in self.hidden_layers:
+            x = layer(x)
+        return tf.squeeze(self.reg(x), axis=-1)
+
+def fit_stacked_mlp(model: StackedMLP, X, y, train_mask, val_mask, epochs=500, batch_size=16, learning_rate=0.0015, es_min_delta=1, patience=5, seed=42):
+    """ Train the members of a stacked model on their own rows with per member early stopping on the validation mse,
+        following `tf.keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=es_min_delta, patience=patience)`.
+
+        :param X: features of every member, `(num_members, num_samples, num_features)`
+        :param y: targets, `(num_samples,)` or `(num_members, num_samples)`
+        :param train_mask: boolean `(num_members, num_samples)`, the training rows of every member
+        :param val_mask: boolean `(num_members, num_samples)`, the validation rows of every member
+        Return a `pd.DataFrame` of the validation loss history, one column per member.
+    """
+    num_members = X.shape[0]
+    X = tf.constant(X, dtype=tf.float32)
+    Y = tf.constant(np.broadcast_to(y, train_mask.shape), dtype=tf.float32)
+    val_weight = tf.constant(val_mask, dtype=tf.float32)
+    optimizer = tf.keras.optimizers.RMSprop(learning_rate)
+
+    train_idx = [np.flatnonzero(mask) for mask in train_mask]
+    steps = int(np.ceil(max(len(idx) for idx in train_idx) / batch_size))
+    rng = np.random.default_rng(seed)
+
+    @tf.function
+    def train_step(idx, weight, active):
+        x, y_true = tf.gather(X, idx, batch_dims=1), tf.gather(Y, idx, batch_dims=1)
+        with tf.GradientTape() as tape:
+            y_pred = model(x, training=True)
+            member_loss = tf.reduce_sum(weight * tf.square(y_pred - y_true), axis=1) / tf.maximum(tf.reduce_sum(weight, axis=1), 1.)
+            loss = tf.reduce_sum(member_loss * active) # stopped members get no gradient
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
+    @tf.function
+    def val_loss():
+        return tf.reduce_sum(val_weight * tf.square(model(X) - Y), axis=1) / tf.maximum(tf.reduce_sum(val_weight, axis=1), 1.)
+
+    active = np.ones(num_members, dtype=np.float32)
+    best = np.full(num_members, np.inf)
+    wait = np.zeros(num_members, dtype=int)
+    history = []
+
+    for _ in range(epochs):
+        # every member shuffles its own training rows, the shorter ones are padded with zero weight rows
+        idx = np.zeros((num_members, steps * batch_size), dtype=np.int64)
+        weight = np.zeros((num_members, steps * batch_size), dtype=np.float32)
+        for k, member_idx in enumerate(train_idx):
+            idx[k, :len(member_idx)] = rng.permutation(member_idx)
+            weight[k, :len(member_idx)] = 1.
+
+        for step in range(steps):
+            batch = slice(step * batch_size, (step + 1) * batch_size)
+            train_step(idx[:, batch], weight[:, batch], active)
+
+        current = val_loss().numpy()
+        history.append(np.where(active > 0, current, np.nan))
+
+        improved = current + abs(es_min_delta) < best
+        best = np.where(improved & (active > 0), current, best)
+        wait = np.where(improved, 0, wait + 1)
+        active = np.where(wait >= patience, 0., active).astype(np.float32)
+        if not active.any():
+            break
+
+    return pd.DataFrame(history)
+
+def kfold_validate_stacked_neural_networks(X: pd.DataFrame, y: pd.Series, layer_dimensions, cv=10, es_min_delta=1, seed=42):
+    """ Perform the KFold predict and validation of `final_model_selection.kfold_predict_validate_neural_network`
+        for several (num_hidden_layer, dimension) configurations, all the folds of the configurations
+        with the same number of hidden layers are trained together as one stacked model.
+
+        Return a dict of `(num_hidden_layer, dimension)` to `(y_pred, cv_eval_df, overall_score)`.
+    """
+    if not all(X.index == y.index):
+        raise ValueError('Index of X and y are not equal!')
+
+    kfold = KFold(n_splits=cv)
+    cha_id_arr = np.array(X.index)
+    Xnp, ynp = X.to_numpy(), y.to_numpy()
+    num_samples = len(Xnp)
+
+    # fold preprocessing is shared between the configurations
+    fold_X, fold_train_mask, fold_val_mask, fold_test_idx = [], [], [], []
+    for train_idx, test_idx in kfold.split(Xnp):
+        scaler = StandardScaler().fit(Xnp[train_idx])
+        normer = Normalizer().fit(Xnp[train_idx])
+        fold_X.append(normer.transform(scaler.transform(Xnp)))
+
+        split = int(len(train_idx) * (1 - 0.2)) # the last 20% like keras `validation_split=0.2`
+        train_mask, val_mask = np.zeros(num_samples, dtype=bool), np.zeros(num_samples, dtype=bool)
+        train_mask[train_idx[:split]], val_mask[train_idx[split:]] = True, True
+        fold_train_mask.append(train_mask)
+        fold_val_mask.append(val_mask)
+        fold_test_idx.append(test_idx)
+
+    configs_by_depth = defaultdict(list)
+    for num_hidden_layer, dimension in layer_dimensions:
+        configs_by_depth[num_hidden_layer].append(dimension)
+
+    results = {}
+    for num_hidden_layer, dimensions in configs_by_depth.items():
+        members = [(dimension, fold) for dimension in dimensions for fold in range(cv)]
+        model = StackedMLP(num_hidden_layer, [dimension for dimension, _ in members], input_dim=Xnp.shape[1])
+        fit_stacked_mlp(
+            model,
+            np.stack([fold_X[fold] for _, fold in members]),
+            ynp,
+            np.stack([fold_train_mask[fold] for _, fold in members]),
+            np.stack([fold_val_mask[fold] for _, fold in members]),
+            es_min_delta=es_min_delta,
+            seed=seed,
+        )
+        member_pred = model(tf.constant(np.stack([fold_X[fold] for _, fold in members]), dtype=tf.float32)).numpy()
+
+        for dimension in dimensions:
+            pred_sr_lst = []
+            cv_eval_res = []
+            for k, (member_dimension, fold) in enumerate(members):
+                if member_dimension != dimension:
+                    continue
+                test_idx = fold_test_idx[fold]
+                y_test, y_p = ynp[test_idx], member_pred[k, test_idx]
+                pred_sr_lst.append(pd.Series(y_p, index=cha_id_arr[test_idx]))
+
+                cv_eval_res.append({
+                    'r2': r2_score(y_test, y_p),
+                    'mae': mean_absolute_error(y_test, y_p),
+                    'mse': mean_squared_error(y_test, y_p),
+                    'mre': mre(y_test, y_p)
+                })
+
+            y_pred = pd.concat(pred_sr_lst).reindex(X.index)
+            overall_score = {
+                'r2': r2_score(y, y_pred),
+                'mae': mean_absolute_error(y, y_pred),
+                'mse': mean_squared_error(y, y_pred),
+                'mre': mre(y, y_pred)
+            }
+            results[(num_hidden_layer, dimension)] = (y_pred, pd.DataFrame.from_records(cv_eval_res), overall_score)
+
+    return results
+
+def kfold_predict_validate_stacked_neural_network(X: pd.DataFrame, y: pd.Series, cv=10, num_hidden_layer=2, dimension=64, es_min_delta=1):
+    """ Drop-in replacement of `final_model_selection.kfold_predict_validate_neural_network`
+        that trains the folds together as one stacked model.
+    """
+    return kfold_validate_stacked_neural_networks(X, y, [(num_hidden_layer, dimension)], cv, es_min_delta)[(num_hidden_layer, dimension)]
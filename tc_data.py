@@ -2,11 +2,12 @@
 import os
 import json
 import re
+import shutil
+import hashlib
 from collections import defaultdict
 
 import numpy as np
 import pandas as pd
-import tensorflow as tf
 from bs4 import BeautifulSoup, NavigableString, Tag
 from sklearn import preprocessing
 
@@ -63,6 +64,57 @@ def extract_sections_from_html(req):
     
     return {sec_name: ' '.join(' '.join(sec_reqs).split()) for sec_name, sec_reqs in sectioned_req_dct.items()}
 
+def to_contiguous_array(df: pd.DataFrame, dtype=None):
+    """ Export a DataFrame as one C-contiguous array of `dtype` (rows of samples) with at most one copy,
+        so it can be sliced into batches or handed over to TensorFlow without a per-row copy.
+    """
+    return np.ascontiguousarray(df.to_numpy(dtype=dtype))
+
+def rank_section(sec_name, section_priority):
+    """ Rank of a requirement section by the first keyword of `section_priority` found in its name, lower is more valuable."""
+    for rank, keyword in enumerate(section_priority):
+        if keyword == 'overview' and ('project' in sec_name or 'technology_overview' in sec_name):
+            continue # same overview filtering as `TopCoder.get_challenge_overview`
+        if keyword in sec_name:
+            return rank
+    return len(section_priority)
+
+def tokenizer_identity(tokenizer):
+    """ Identity of a tokenizer for the cache keys, taken from the tokenizer only: its class, a hash of its vocabulary
+        and its settings. Tokenizers of transformers 3.0 don't keep the name they were loaded from.
+    """
+    import transformers # the tokenizer is passed in so it's already imported
+
+    vocab_fn = tokenizer.init_kwargs.get('vocab_file')
+    if vocab_fn and os.path.isfile(vocab_fn):
+        with open(vocab_fn, 'rb') as fread:
+            vocab_sha1 = hashlib.sha1(fread.read()).hexdigest()
+    else:
+        vocab_sha1 = hashlib.sha1(json.dumps(sorted(tokenizer.get_vocab().items())).encode()).hexdigest()
+
+    return {
+        'tokenizer': type(tokenizer).__name__,
+        'vocab_sha1': vocab_sha1,
+        'vocab_size': tokenizer.vocab_size,
+        'settings': {k: v for k, v in sorted(tokenizer.init_kwargs.items()) if isinstance(v, (bool, int, float, str)) and not k.endswith('_file')},
+        'special_tokens': tokenizer.special_tokens_map,
+        'transformers': transformers.__version__,
+    }
+
+def bert_encoding_cache_key(tokenizer, texts: pd.Series, padding, max_length, extract_overview):
+    """ Hash the tokenizer identity, encoding params and the text data into a cache key."""
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps({
+        **tokenizer_identity(tokenizer),
+        'padding': padding,
+        'max_length': max_length,
+        'extract_overview': extract_overview,
+    }, sort_keys=True).encode())
+    for cha_id, text in texts.items():
+        hasher.update(f'{cha_id}\t{text}\n'.encode())
+
+    return hasher.hexdigest()[:20]
+
 class TopCoder:
     """ Read the detailed requirements and numeric data of challenges
         into pandas DataFrame.
@@ -76,6 +128,7 @@ class TopCoder:
     dvec_path = os.path.join(data_path, 'document_vec_100D.json')
     score_path = os.path.join(data_path, 'challenge_score_stat.json')
     cha_reg_dir = os.path.join(data_path, 'challenge_registration')
+    bert_cache_dir = os.path.join(data_path, 'bert_encoded') # cache of tokenized requirements
 
     develop_challenge_prize_range = {
         'FIRST_2_FINISH': (0, 600),
@@ -93,10 +146,17 @@ class TopCoder:
         'CONCEPTUALIZATION': (1500, 2000)
     }
 
+    # keywords of section names ordered by how informative the section is for pricing
+    section_priority = ('overview', 'requirement', 'scope', 'task', 'deliverable', 'technolog', 'no_header_tag')
+
+    final_targets = ('total_prize', 'avg_score', 'number_of_registration', 'sub_reg_ratio')
+
     def __init__(self):
         self.titles, self.requirements = self.process_detailed_requirements()
         self.challenge_basic_info: pd.DataFrame = self.read_challenge_basic_info()
         self.global_features = self.extract_global_context_features()
+        self._final_features = None # built on the first call of `get_final_features`
+        self._multi_target_features = None
 
     def process_detailed_requirements(self) -> (pd.DataFrame, pd.DataFrame):
         """ Process the detailed requirements from loaded json"""
@@ -216,6 +276,65 @@ class TopCoder:
         else:
             return cha_req.loc[cha_req.index.isin(filtered_cha_id)].rename(columns={'requirements_by_section': 'requirements'}).sort_index()
 
+    def get_budgeted_requirements(self, tokenizer, token_budget=256, use_cache=True):
+        """ Pack the most valuable sections of every filtered challenge into `token_budget` tokens.
+            Sections are ranked by `section_priority` and packed greedily,
+            the packed sections keep their original order in the requirement text.
+
+            :param use_cache: load the packed requirements from `bert_cache_dir`, keyed by the tokenizer,
+            the budget, the section priority and the sections, pack and store them first on cache miss
+        """
+        filtered_cha_id = self.get_filtered_challenge_id()
+        sections = self.requirements.loc[self.requirements.index.get_level_values(1).isin(filtered_cha_id), 'requirements_by_section']
+
+        if not use_cache:
+            return self.pack_requirement_sections(tokenizer, sections, token_budget)
+
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps({
+            **tokenizer_identity(tokenizer),
+            'token_budget': token_budget,
+            'section_priority': list(self.section_priority),
+        }, sort_keys=True).encode())
+        for (_, cha_id, sec_name), text in sections.items():
+            hasher.update(f'{cha_id}\t{sec_name}\t{text}\n'.encode())
+        cache_fn = os.path.join(self.bert_cache_dir, f'budgeted_requirements_{hasher.hexdigest()[:20]}.json')
+
+        if not os.path.isfile(cache_fn):
+            packed_req = self.pack_requirement_sections(tokenizer, sections, token_budget)
+            os.makedirs(self.bert_cache_dir, exist_ok=True)
+            tmp_fn = f'{cache_fn}.tmp{os.getpid()}' # write aside and rename so a killed run never leaves a partial cache
+            packed_req.to_json(tmp_fn, orient='index', indent=4)
+            os.replace(tmp_fn, cache_fn)
+            return packed_req
+
+        return pd.read_json(cache_fn, orient='index', dtype={'requirements': str}).rename_axis('challenge_id').sort_index()
+
+    def pack_requirement_sections(self, tokenizer, sections: pd.Series, token_budget):
+        """ Pack the `requirements_by_section` of the challenges into `token_budget` tokens, see `get_budgeted_requirements`."""
+        section_df = pd.DataFrame({
+            'position': np.arange(len(sections)),
+            'rank': [rank_section(sec_name, self.section_priority) for sec_name in sections.index.get_level_values(2)],
+            'num_tokens': [len(ids) for ids in tokenizer(sections.to_list(), add_special_tokens=False)['input_ids']],
+            'text': sections.to_numpy(),
+        }, index=sections.index.get_level_values(1))
+        text_budget = token_budget - tokenizer.num_special_tokens_to_add()
+
+        packed_req = {}
+        for cha_id, cha_sections in section_df.groupby(level=0):
+            remaining = text_budget
+            selected = []
+            for position, _, num_tokens, text in cha_sections.sort_values(['rank', 'position']).itertuples(index=False):
+                if num_tokens <= remaining or not selected: # the most valuable section is always kept, the tokenizer truncates it
+                    selected.append((position, text))
+                    remaining -= num_tokens
+                if remaining <= 0:
+                    break
+
+            packed_req[cha_id] = ' '.join(text for _, text in sorted(selected))
+
+        return pd.DataFrame.from_dict(packed_req, orient='index', columns=['requirements']).rename_axis('challenge_id').sort_index()
+
     def calculate_tech_popularity(self):
         """ Calculate popularity of used technology in filtered challenges"""
         filtered_cha_id = self.get_filtered_challenge_id()
@@ -254,11 +373,13 @@ class TopCoder:
         softmax_tech=False,
         contain_dv=False,
         contain_prize=False,
-        return_df=False
+        return_df=False,
+        dtype=None
         ):
         """ Get meta data as training features.
 
-            :param return_tensor: when True, return a list of Tensor(shape)
+            :param return_tensor: when True, return one float32 Tensor of shape (num_challenges, num_features)
+            :param dtype: dtype of the returned array, e.g. np.float32 to feed a NN without casting again
             :param normalize: whether to use (df - df.mean()) / df.std() to normalize
             data
         """
@@ -295,19 +416,92 @@ class TopCoder:
         if return_df:
             return metadata_df
 
-        return [tf.constant(row) for row in metadata_df.itertuples(index=False)] if return_tensor else metadata_df.to_numpy(copy=True)
+        if return_tensor:
+            import tensorflow as tf
+            return tf.convert_to_tensor(to_contiguous_array(metadata_df, np.float32))
+
+        return to_contiguous_array(metadata_df, dtype)
+
+    def get_meta_data_array(self, dtype=np.float32, **feature_kwargs):
+        """ Return the meta data features as one C-contiguous array of `dtype` and the column manifest,
+            i.e. the feature names in the column order of the array.
+
+            :param feature_kwargs: the feature selection parameters of `get_meta_data_features`
+        """
+        metadata_df = self.get_meta_data_features(**feature_kwargs, return_df=True)
+        return to_contiguous_array(metadata_df, dtype), metadata_df.columns.astype(str).to_list()
+
+    def build_meta_data_tf_dataset(self, dtype=np.float32, **feature_kwargs):
+        """ Return a `tf.data.Dataset` of `(meta_data_features, total_prize)` built from the contiguous arrays
+            of `get_meta_data_array` and `get_target`, and the column manifest of the features.
+        """
+        import tensorflow as tf
+        metadata, columns = self.get_meta_data_array(dtype, **feature_kwargs)
+        return tf.data.Dataset.from_tensor_slices((metadata, self.get_target(dtype=dtype))), columns
+
+    def get_bert_encoded_txt_features(self, tokenizer, extract_overview=False, return_tensor=False, use_cache=False, padding=True, max_length=None, token_budget=None):
+        """ Method that return encoded text from the bert tokenizer
+
+            :param use_cache: load the encoded `input_ids` and `attention_mask` from the on-disk cache,
+            the arrays are memory mapped and keep the compact dtype of the cache unless `return_tensor`
+            :param token_budget: pack the most valuable sections into this many tokens instead of
+            using the whole requirement (or overview), it overrides `extract_overview` and `max_length`
+        """
+        if token_budget:
+            req = self.get_budgeted_requirements(tokenizer, token_budget)
+            max_length = token_budget
+        else:
+            req = self.get_filtered_requirements(extract_overview)
+
+        if use_cache:
+            encoded = self.load_bert_encoding_cache(tokenizer, req['requirements'], padding, max_length, extract_overview)
+            if return_tensor:
+                import tensorflow as tf
+                return {k: tf.cast(arr, tf.int32) for k, arr in encoded.items()}
+            return encoded
 
-    def get_bert_encoded_txt_features(self, tokenizer, extract_overview=False, return_tensor=False):
-        """ Method that return encoded text from the bert tokenizer"""
-        req = self.get_filtered_requirements(extract_overview)
-        batch_encoding = tokenizer(req['requirements'].to_list(), padding=True, truncation=True, return_tensors='tf' if return_tensor else None)
+        batch_encoding = tokenizer(req['requirements'].to_list(), padding=padding, truncation=True, max_length=max_length, return_tensors='tf' if return_tensor else None)
         return batch_encoding.data
 
-    def get_target(self, return_tensor=False):
-        """ Return the total prize as np.array or Tensor."""
-        prz_arr = self.get_filtered_challenge_info()['total_prize'].to_numpy()
+    def get_bert_encoding_cache_path(self, tokenizer, texts: pd.Series, padding=True, max_length=None, extract_overview=False):
+        """ Return the cache directory of the tokenized texts, other per-encoding caches can be stored there as well."""
+        return os.path.join(self.bert_cache_dir, bert_encoding_cache_key(tokenizer, texts, padding, max_length, extract_overview))
 
-        return [tf.constant(prz) for prz in prz_arr] if return_tensor else prz_arr
+    def load_bert_encoding_cache(self, tokenizer, texts: pd.Series, padding=True, max_length=None, extract_overview=False):
+        """ Load the tokenized texts from cache, tokenize and store them first on cache miss.
+            Arrays are stored as int16 when the vocabulary fits, otherwise int32, and loaded memory mapped.
+        """
+        cache_path = self.get_bert_encoding_cache_path(tokenizer, texts, padding, max_length, extract_overview)
+
+        if not os.path.isdir(cache_path):
+            batch_encoding = tokenizer(texts.to_list(), padding=padding, truncation=True, max_length=max_length)
+            dtype = np.int16 if tokenizer.vocab_size <= np.iinfo(np.int16).max else np.int32
+
+            tmp_path = f'{cache_path}.tmp{os.getpid()}' # write aside and rename so a killed run never leaves a partial cache
+            os.makedirs(tmp_path, exist_ok=True)
+            for k in ('input_ids', 'attention_mask'):
+                np.save(os.path.join(tmp_path, f'{k}.npy'), np.asarray(batch_encoding[k], dtype=dtype))
+            np.save(os.path.join(tmp_path, 'challenge_id.npy'), texts.index.to_numpy())
+
+            try:
+                os.rename(tmp_path, cache_path)
+            except OSError: # another process finished the same cache first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        if not np.array_equal(np.load(os.path.join(cache_path, 'challenge_id.npy')), texts.index.to_numpy()):
+            raise ValueError(f'Cached encoding at {cache_path} is not aligned with the given texts.')
+
+        return {k: np.load(os.path.join(cache_path, f'{k}.npy'), mmap_mode='r') for k in ('input_ids', 'attention_mask')}
+
+    def get_target(self, return_tensor=False, dtype=None):
+        """ Return the total prize as np.array of `dtype` or float32 Tensor."""
+        prz_arr = self.get_filtered_challenge_info()['total_prize'].to_numpy(dtype=dtype)
+
+        if return_tensor:
+            import tensorflow as tf
+            return tf.convert_to_tensor(prz_arr, dtype=tf.float32)
+
+        return prz_arr
 
     def extract_global_context_features(self):
         """ Detect the challenges that are open simutanously
@@ -381,22 +575,46 @@ class TopCoder:
             'num_of_active_workers': len(active_workers),
         }
 
+    def get_final_features(self):
+        """ Return the features of the final dataset (with `total_prize`), computed once and cached."""
+        if self._final_features is None:
+            metadata_features = self.get_meta_data_features(
+                encoded_tech=True,
+                softmax_tech=True,
+                contain_dv=True,
+                contain_prize=True,
+                return_df=True,
+            )
+            self._final_features = pd.concat([self.global_features, metadata_features], axis=1)
+
+        return self._final_features
+
     def build_final_dataset(self, target: str):
         """ Build the dataset that combines metadata, document vectors and """
-        if target not in ('total_prize', 'avg_score', 'number_of_registration', 'sub_reg_ratio'):
+        if target not in self.final_targets:
             raise ValueError('target is not valid, only options are \'total_prize\', \'avg_score\', \'number_of_registration\', \'sub_reg_ratio\'.')
 
-        contain_prize = not bool(target == 'total_prize')
-
-        metadata_features = self.get_meta_data_features(
-            encoded_tech=True,
-            softmax_tech=True,
-            contain_dv=True,
-            contain_prize=contain_prize,
-            return_df=True,
-        )
-
-        X = pd.concat([self.global_features, metadata_features], axis=1)
+        X = self.get_final_features()
+        if target == 'total_prize':
+            X = X.drop(columns='total_prize')
+        else:
+            X = X.copy()
         y = self.get_filtered_challenge_info()[target]
 
         return X, y
+
+    def build_multi_target_dataset(self):
+        """ Build the dataset of all the final targets at once.
+
+            Return `(X_with_prize, X_without_prize, Y)`, the features are one float64 block with `total_prize`
+            as the last column so `X_without_prize` is a column slice of `X_with_prize` without copy,
+            `Y` holds one column per target. The features are built once per instance.
+        """
+        if self._multi_target_features is None:
+            X = self.get_final_features()
+            self._multi_target_features = X.reindex(columns=[*X.columns.drop('total_prize'), 'total_prize']).astype(np.float64)
+
+        X_with_prize = self._multi_target_features
+        Y = self.get_filtered_challenge_info().reindex(X_with_prize.index)[list(self.final_targets)].astype(np.float64)
+
+        return X_with_prize, X_with_prize.iloc[:, :-1], Y
@@ -0,0 +1,183 @@
+""" TensorFlow implementations of the precision and recall for regression of `imbalanced_regression_metrics`,
+    kept apart so that importing the NumPy implementation doesn't import TensorFlow.
+"""
+from typing import Union, Tuple
+
+import tensorflow as tf
+
+from imbalanced_regression_metrics import PrecisionRecallFscoreForRegression
+
+class TFPrecisionRecallFscoreForRegression(PrecisionRecallFscoreForRegression):
+    """ A reimplementation of class PrecisionRecallFscoreForRegression using TensorFlow.
+        This is due to the uncompatibility of numpy ops for a "SymbolicTensor"
+    """
+    @classmethod
+    def sigmoid_base(cls, exp_pow):
+        return tf.cast(1 / (1 + tf.math.exp(-1 * exp_pow)), tf.float32)
+
+    @classmethod
+    def compute_s(cls, c, decay, delta, low=False):
+        coeff = -1 if low else 1
+        return tf.cast(coeff * tf.math.log((delta ** -1) - 1) / tf.math.abs(c * decay), tf.float32)
+
+    @classmethod
+    def compute_loss(cls, y_true, y_pred):
+        return tf.cast(tf.math.abs(y_true - y_pred), tf.float32)
+
+    def __init__(
+        self,
+        tE: float,
+        tL: float,
+        c: Union[int, float, Tuple[Union[int, float], Union[int, float]]],
+        extreme: str,
+        decay=0.5,
+        delta=1e-4,
+        k=8,
+        use_smoother_alpha: bool = True,
+        beta: float = 0.5
+    ):
+        super().__init__(tE, tL, c, extreme, decay, delta, k, use_smoother_alpha, beta)
+        self.tE = tE
+        self.tL = tL
+        self.c = c
+        self.k = k # this k is for the computation of smooth-alpha
+        self.use_smoother_alpha = use_smoother_alpha
+        self.beta = beta
+
+        if extreme == 'both':
+            self.s = (
+                self.compute_s(c[0], decay, delta, low=True),
+                self.compute_s(c[1], decay, delta)
+            )
+        else:
+            self.s = self.compute_s(c, decay, delta, low=(extreme == 'low'))
+
+    def indicator(self, y_true, y_pred):
+        return tf.cast(self.compute_loss(y_true, y_pred) <= self.tL, tf.int32)
+
+    def alpha(self, y_true, y_pred):
+        return tf.cast(self.indicator(y_true, y_pred), tf.float32)
+
+    def smoother_alpha(self, y_true, y_pred):
+        return tf.cast(self.indicator(y_true, y_pred), tf.float32) *\
+            (1 - tf.math.exp(-1 * self.k * ((self.compute_loss(y_true, y_pred) - self.tL) / self.tL) ** 2))
+
+    def phi(self, y):
+        if isinstance(self.c, (int, float)):
+            return self.sigmoid_base(self.s * (y - self.c))
+
+        elif isinstance(self.c, tuple):
+            output_tensor = tf.cast(tf.identity(y), tf.float32) # make a copy of input tensor
+
+            c_low, c_high = self.c
+            s_low, s_high = self.s
+            sigmoid_low = self.sigmoid_base(s_low * (y - c_low))
+            sigmoid_high = self.sigmoid_base(s_high * (y - c_high))
+
+            symmetry_point = (c_low + c_high) / 2
+            output_tensor = tf.where(y <= symmetry_point, sigmoid_low, output_tensor)
+            output_tensor = tf.where(y > symmetry_point, sigmoid_high, output_tensor)
+            return output_tensor
+
+    def precision(self, y_true, y_pred):
+        alpha_func = self.smoother_alpha if self.use_smoother_alpha else self.alpha
+
+        alpha = alpha_func(y_true, y_pred)
+        phi_y_pred = self.phi(y_pred)
+
+        numerator = tf.math.reduce_sum(tf.boolean_mask(alpha * phi_y_pred, phi_y_pred >= self.tE))
+        denominator = tf.math.reduce_sum(tf.boolean_mask(phi_y_pred, phi_y_pred >= self.tE))
+
+        return numerator / denominator
+
+    def recall(self, y_true, y_pred):
+        alpha_func = self.smoother_alpha if self.use_smoother_alpha else self.alpha
+
+        alpha = alpha_func(y_true, y_pred)
+        phi_y_true = self.phi(y_true)
+
+        numerator = tf.math.reduce_sum(tf.boolean_mask(alpha * phi_y_true, phi_y_true >= self.tE))
+        denominator = tf.math.reduce_sum(tf.boolean_mask(phi_y_true, phi_y_true >= self.tE))
+
+        return numerator / denominator
+
+    def fscore(self, y_true, y_pred):
+        precision = self.precision(y_true, y_pred)
+        recall = self.recall(y_true, y_pred)
+        beta_square = self.beta ** 2
+
+        return (beta_square + 1) * precision * recall / (beta_square * precision + recall)
+
+class StreamingPrecisionRecallFscoreForRegression(tf.keras.metrics.Metric):
+    """ Stateful Keras metric of the precision, recall or F-score for regression.
+
+        The numerators and denominators of precision and recall are accumulated over the batches,
+        so the result is the score of the whole epoch instead of an average of batch scores.
+        Like `PrecisionRecallFscoreForRegression`, a score with a zero denominator is 0.
+
+        :param score: the reported score, one of "precision", "recall" or "fscore",
+        the other parameters are the ones of `PrecisionRecallFscoreForRegression`
+    """
+
+    def __init__(
+        self,
+        tE: float,
+        tL: float,
+        c: Union[int, float, Tuple[Union[int, float], Union[int, float]]],
+        extreme: str,
+        decay=0.5,
+        delta=1e-4,
+        k=8,
+        use_smoother_alpha: bool = True,
+        beta: float = 0.5,
+        score='fscore',
+        name=None,
+        **kwargs
+    ):
+        if score not in ('precision', 'recall', 'fscore'):
+            raise ValueError(f'`score` should be one of ("precision", "recall", "fscore"), receive {score}')
+
+        super().__init__(name=name or f'{score}_for_regression', **kwargs)
+        c = tuple(c) if isinstance(c, list) else c # a tuple `c` comes back as a list from a serialized config
+        self.prf = TFPrecisionRecallFscoreForRegression(tE, tL, c, extreme, decay, delta, k, use_smoother_alpha, beta)
+        self.score = score
+        self.config = dict(tE=tE, tL=tL, c=c, extreme=extreme, decay=decay, delta=delta, k=k, use_smoother_alpha=use_smoother_alpha, beta=beta, score=score)
+
+        self.precision_numerator = self.add_weight('precision_numerator', initializer='zeros')
+        self.precision_denominator = self.add_weight('precision_denominator', initializer='zeros')
+        self.recall_numerator = self.add_weight('recall_numerator', initializer='zeros')
+        self.recall_denominator = self.add_weight('recall_denominator', initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.reshape(tf.cast(y_true, tf.float32), [-1])
+        y_pred = tf.reshape(tf.cast(y_pred, tf.float32), [-1])
+        weight = tf.ones_like(y_true) if sample_weight is None else tf.reshape(tf.cast(sample_weight, tf.float32), [-1])
+
+        alpha = self.prf.smoother_alpha(y_true, y_pred) if self.prf.use_smoother_alpha else self.prf.alpha(y_true, y_pred)
+        phi_y_pred, phi_y_true = self.prf.phi(y_pred), self.prf.phi(y_true)
+        # relevance of the values below the threshold tE is left out of the sums
+        phi_y_pred = tf.where(phi_y_pred >= self.prf.tE, phi_y_pred * weight, tf.zeros_like(phi_y_pred))
+        phi_y_true = tf.where(phi_y_true >= self.prf.tE, phi_y_true * weight, tf.zeros_like(phi_y_true))
+
+        self.precision_numerator.assign_add(tf.reduce_sum(alpha * phi_y_pred))
+        self.precision_denominator.assign_add(tf.reduce_sum(phi_y_pred))
+        self.recall_numerator.assign_add(tf.reduce_sum(alpha * phi_y_true))
+        self.recall_denominator.assign_add(tf.reduce_sum(phi_y_true))
+
+    def result(self):
+        precision = tf.math.divide_no_nan(self.precision_numerator, self.precision_denominator)
+        recall = tf.math.divide_no_nan(self.recall_numerator, self.recall_denominator)
+        if self.score == 'precision':
+            return precision
+        if self.score == 'recall':
+            return recall
+
+        beta_square = self.prf.beta ** 2
+        return tf.math.divide_no_nan((beta_square + 1) * precision * recall, beta_square * precision + recall)
+
+    def reset_states(self):
+        for variable in self.variables:
+            variable.assign(0.)
+
+    def get_config(self):
+        return {**super().get_config(), **self.config}
@@ -0,0 +1,143 @@
+""" A Keras training loop with periodic checkpoints, best model retention,
+    early stopping and exact resume for the long running TCPM training entry points.
+
+    The checkpoint holds the model, the optimizer, the position of the training data iterator
+    and the loop counters, so a run restarted with the same `ckpt_dir` continues from the last checkpoint
+    as if it had never stopped.
+"""
+import os
+import json
+
+import pandas as pd
+import tensorflow as tf
+from tensorflow.python.keras.callbacks import CallbackList # not exported as `tf.keras.callbacks.CallbackList` in TF 2.2
+
+from multiworker_launcher import get_worker_info
+
+def fit_with_checkpoints(
+    model: tf.keras.Model,
+    train_ds: tf.data.Dataset,
+    ckpt_dir: str,
+    epochs: int,
+    steps_per_epoch: int = None,
+    validation_data: tf.data.Dataset = None,
+    monitor='val_loss',
+    mode='min',
+    patience=3,
+    min_delta=0,
+    save_every_n_steps: int = None,
+    max_to_keep=2,
+    restore_best_weights=True,
+    callbacks=None,
+):
+    """ Train a compiled model, resuming from the latest checkpoint in `ckpt_dir` if there is one.
+
+        :param train_ds: training dataset, it's repeated so an epoch is `steps_per_epoch` steps
+        (default to the number of batches of one pass), it must not be built with `from_generator`
+        or `tf.numpy_function` so that the iterator position can be checkpointed
+        :param monitor: metric of the epoch logs used for best model retention and early stopping
+        :param save_every_n_steps: also checkpoint in the middle of an epoch every n steps,
+        by default a checkpoint is written at the end of every epoch
+        :param restore_best_weights: load the weights of the best epoch into the model when training ends
+        :param callbacks: Keras callbacks, called on train begin/end, epoch begin/end and batch begin/end
+
+        Return the history as a `pd.DataFrame`, also written to `train_history.json` in `ckpt_dir`
+        with the weights of the best epoch in `ckpt_dir/best`.
+
+        When the model is built under a `MultiWorkerMirroredStrategy` every batch of `train_ds` is a global batch
+        split across the workers, so an epoch is the same number of steps on every worker as on a single one.
+        All the workers must be given the same `ckpt_dir`, only the chief writes to it
+        (the other workers save to `ckpt_dir/worker_{i}`). The distributed iterator
+        can't be checkpointed, a resumed multi-worker run reads the data from the start again.
+    """
+    if mode not in ('min', 'max'):
+        raise ValueError(f'`mode` should be either "min" or "max", received {mode}')
+
+    task_index, num_workers = get_worker_info()
+    if steps_per_epoch is None:
+        steps_per_epoch = int(tf.data.experimental.cardinality(train_ds))
+        if steps_per_epoch == tf.data.experimental.INFINITE_CARDINALITY:
+            raise ValueError('`train_ds` is infinite, pass `steps_per_epoch` explicitly.')
+        if steps_per_epoch == tf.data.experimental.UNKNOWN_CARDINALITY: # e.g. bucketed batches, count one pass
+            steps_per_epoch = int(train_ds.reduce(tf.constant(0, dtype=tf.int64), lambda count, _: count + 1))
+
+    if task_index != 0:
+        ckpt_dir = os.path.join(ckpt_dir, f'worker_{task_index}')
+
+    history_fn = os.path.join(ckpt_dir, 'train_history.json')
+    best_fn = os.path.join(ckpt_dir, 'best', 'weights')
+    sign = 1 if mode == 'min' else -1
+    os.makedirs(os.path.dirname(best_fn), exist_ok=True)
+
+    # every worker runs the same number of steps, the data is repeated so that no worker runs out of batches
+    iterator = iter(model.distribute_strategy.experimental_distribute_dataset(train_ds.repeat()))
+    state = {
+        'epoch': tf.Variable(0, dtype=tf.int64, trainable=False),
+        'step': tf.Variable(0, dtype=tf.int64, trainable=False), # step within the epoch
+        'best': tf.Variable(sign * float('inf'), dtype=tf.float64, trainable=False),
+        'wait': tf.Variable(0, dtype=tf.int64, trainable=False),
+    }
+    if num_workers == 1:
+        state['iterator'] = iterator
+    ckpt = tf.train.Checkpoint(model=model, optimizer=model.optimizer, **state)
+    manager = tf.train.CheckpointManager(ckpt, ckpt_dir, max_to_keep=max_to_keep)
+
+    history = []
+    if manager.latest_checkpoint:
+        ckpt.restore(manager.latest_checkpoint)
+        if os.path.isfile(history_fn):
+            history = pd.read_json(history_fn, orient='index').sort_index().to_dict(orient='records')
+        print(f'Resume from {manager.latest_checkpoint}: epoch {int(state["epoch"])}, step {int(state["step"])}')
+
+    callbacks = CallbackList(callbacks, add_progbar=True, model=model, verbose=1, epochs=epochs, steps=steps_per_epoch)
+    train_function = model.make_train_function()
+
+    callbacks.on_train_begin()
+    while int(state['epoch']) < epochs and int(state['wait']) < patience:
+        epoch = int(state['epoch'])
+        if int(state['step']) == 0:
+            model.reset_metrics()
+        callbacks.on_epoch_begin(epoch)
+
+        logs = {}
+        while int(state['step']) < steps_per_epoch:
+            step = int(state['step'])
+            callbacks.on_train_batch_begin(step)
+            logs = train_function(iterator)
+            callbacks.on_train_batch_end(step, logs)
+            state['step'].assign_add(1)
+
+            if save_every_n_steps and int(state['step']) % save_every_n_steps == 0 and int(state['step']) < steps_per_epoch:
+                manager.save()
+
+        logs = {k: float(v) for k, v in logs.items()}
+        if validation_data is not None:
+            val_logs = model.evaluate(validation_data, return_dict=True, verbose=0)
+            logs.update({f'val_{k}': float(v) for k, v in val_logs.items()})
+        callbacks.on_epoch_end(epoch, logs)
+
+        if sign * (logs[monitor] - float(state['best'])) < -min_delta:
+            state['best'].assign(logs[monitor])
+            state['wait'].assign(0)
+            model.save_weights(best_fn)
+        else:
+            state['wait'].assign_add(1)
+
+        history.append(logs)
+        state['epoch'].assign_add(1)
+        state['step'].assign(0)
+        manager.save()
+        pd.DataFrame(history).to_json(history_fn, orient='index', indent=4)
+
+    callbacks.on_train_end()
+
+    if int(state['wait']) >= patience:
+        print(f'Early stopping at epoch {int(state["epoch"])}, best {monitor}: {float(state["best"])}')
+
+    with open(os.path.join(ckpt_dir, 'best', 'best_score.json'), 'w') as fwrite:
+        json.dump({'monitor': monitor, 'best': float(state['best'])}, fwrite, indent=4)
+
+    if restore_best_weights and tf.train.latest_checkpoint(os.path.dirname(best_fn)):
+        model.load_weights(best_fn)
+
+    return pd.DataFrame(history)
@@ -0,0 +1,236 @@
+""" Throughput and input stall instrumentation of the TCPM training runs.
+
+    `TrainingInstrumentation` is a Keras callback (for `model.fit` and `fit_with_checkpoints`)
+    that records the wall time of every step, the time spent waiting for the input,
+    examples/sec, tokens/sec and the peak RSS, optionally captures a TF profiler trace of a step window,
+    and writes `train_instrumentation.json` (per epoch) and `train_instrumentation_steps.json` (per step)
+    into the output directory of the run, next to `train_history.json`.
+
+    `InstrumentedTFTrainer` does the same for `TFTrainer` runs.
+"""
+import os
+import time
+import resource
+
+import pandas as pd
+import tensorflow as tf
+import transformers
+from transformers import TFTrainer
+
+# `InstrumentedTFTrainer` overrides private generators of `TFTrainer` that are specific to this version
+TFTRAINER_VERSION = '3.0.2'
+
+def count_examples_and_tokens(dataset: tf.data.Dataset):
+    """ Number of examples and of non padding tokens (the sum of the `attention_mask`) of one pass
+        over a batched dataset of `(features, label)`.
+    """
+    examples, tokens = dataset.reduce(
+        (tf.constant(0, dtype=tf.int64), tf.constant(0, dtype=tf.int64)),
+        lambda count, batch: (
+            count[0] + tf.cast(tf.shape(batch[0]['attention_mask'])[0], tf.int64),
+            count[1] + tf.reduce_sum(tf.cast(batch[0]['attention_mask'], tf.int64)),
+        ),
+    )
+    return int(examples), int(tokens)
+
+def get_peak_rss_mb():
+    """ Peak resident set size of the current process in MB (`ru_maxrss` is in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class TrainingInstrumentation(tf.keras.callbacks.Callback):
+    """ Record step time, input wait, throughput and memory of a training run.
+
+        With `model.fit` the next batch is fetched inside the compiled train step, the input wait is then
+        the host time between two steps and the examples/tokens of an epoch are counted once from `train_ds`.
+        Training loops that fetch the batches in python report the actual time blocked on the input pipeline
+        and the batches with `record_input_wait`.
+
+        :param output_dir: directory to write the instrumentation files to
+        :param batch_size: number of examples of a step when neither the batches nor `train_ds` are given
+        :param train_ds: batched training dataset of `(features, label)` (one pass is an epoch), its examples
+        and non padding tokens are counted on train begin for the throughput of the epochs
+        :param profile_steps: `(start, stop)` global steps to capture a TF profiler trace for, into `output_dir/profile`
+    """
+
+    def __init__(self, output_dir, batch_size=None, train_ds=None, profile_steps=None):
+        super().__init__()
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.train_ds = train_ds
+        self.profile_steps = profile_steps
+        self.epoch_examples, self.epoch_tokens = None, None
+
+        self.step_records = []
+        self.epoch_records = []
+        self.global_step = 0
+        self.epoch = 0
+        self.profiling = False
+        self.reports_input_wait = False # the training loop calls `record_input_wait`
+        self._last_step_end = None
+        self._reset_step()
+
+    def _reset_step(self):
+        self._step_begin = None
+        self._input_wait = None
+        self._examples = None
+        self._tokens = None
+
+    def record_input_wait(self, seconds, features=None):
+        """ Report the time blocked on fetching the (next) batch of the coming step,
+            the examples and tokens of the step are counted from the batch `features` when given.
+        """
+        self.reports_input_wait = True
+        self._input_wait = (self._input_wait or 0) + seconds
+        if features is not None:
+            attention_mask = features['attention_mask']
+            self._examples = (self._examples or 0) + int(attention_mask.shape[0])
+            self._tokens = (self._tokens or 0) + int(tf.reduce_sum(tf.cast(attention_mask, tf.int64)))
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._last_step_end = None
+        if self.train_ds is not None and self.epoch_examples is None:
+            self.epoch_examples, self.epoch_tokens = count_examples_and_tokens(self.train_ds)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self._last_step_end = None
+        self._epoch_begin = time.perf_counter()
+        self._epoch_first_record = len(self.step_records)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        if not self.reports_input_wait and self._last_step_end is not None:
+            self._input_wait = now - self._last_step_end
+
+        if self.profile_steps and self.global_step == self.profile_steps[0] and not self.profiling:
+            tf.profiler.experimental.start(os.path.join(self.output_dir, 'profile'))
+            self.profiling = True
+
+        self._step_begin = now
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        if self._step_begin is None:
+            return
+
+        self.step_records.append({
+            'epoch': self.epoch,
+            'step': batch,
+            'global_step': self.global_step,
+            'step_time': now - self._step_begin,
+            'input_wait': self._input_wait or 0.,
+            'examples': self._examples, # only known when the batches are reported
+            'tokens': self._tokens,
+        })
+
+        self.global_step += 1
+        self._last_step_end = now
+        self._reset_step()
+
+        if self.profiling and self.global_step >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self.profiling = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        steps = pd.DataFrame(self.step_records[self._epoch_first_record:])
+        epoch_time = time.perf_counter() - self._epoch_begin
+        record = {'epoch': epoch, 'epoch_time': epoch_time, 'num_steps': len(steps), 'peak_rss_mb': get_peak_rss_mb()}
+
+        if len(steps) > 0:
+            examples, tokens = self.epoch_examples, self.epoch_tokens
+            if steps['examples'].notna().all():
+                examples = steps['examples'].sum()
+            elif examples is None and self.batch_size is not None:
+                examples = len(steps) * self.batch_size
+            if steps['tokens'].notna().all():
+                tokens = steps['tokens'].sum()
+
+            record.update({
+                'mean_step_time': steps['step_time'].mean(),
+                'median_step_time': steps['step_time'].median(),
+                'p90_step_time': steps['step_time'].quantile(0.9),
+                'total_input_wait': steps['input_wait'].sum(),
+                'input_wait_ratio': steps['input_wait'].sum() / epoch_time,
+                'examples_per_sec': examples / epoch_time if examples is not None else None,
+                'tokens_per_sec': tokens / epoch_time if tokens is not None else None,
+            })
+
+        self.epoch_records.append(record)
+        self.write()
+
+    def on_train_end(self, logs=None):
+        if self.profiling:
+            tf.profiler.experimental.stop()
+            self.profiling = False
+        self.write()
+
+    def write(self):
+        """ Write the records collected so far."""
+        pd.DataFrame(self.epoch_records).to_json(os.path.join(self.output_dir, 'train_instrumentation.json'), orient='index', indent=4)
+        pd.DataFrame(self.step_records).to_json(os.path.join(self.output_dir, 'train_instrumentation_steps.json'), orient='index', indent=4)
+
+class InstrumentedTFTrainer(TFTrainer):
+    """ `TFTrainer` that reports every training step to a `TrainingInstrumentation`.
+
+        The batches are fetched from the dataset iterator in python instead of inside the compiled
+        gradient accumulation step, so that the time blocked on the input pipeline is measured
+        and the tokens of every batch are counted from its `attention_mask`.
+        It overrides the private `_training_steps` and `_accumulate_next_gradients` of `TFTrainer`,
+        which only exist as such in transformers `TFTRAINER_VERSION`.
+    """
+
+    def __init__(self, *args, instrumentation: TrainingInstrumentation = None, **kwargs):
+        if transformers.__version__ != TFTRAINER_VERSION:
+            raise RuntimeError(f'InstrumentedTFTrainer is written against transformers {TFTRAINER_VERSION}, found {transformers.__version__}')
+
+        super().__init__(*args, **kwargs)
+        self.instrumentation = instrumentation or TrainingInstrumentation(
+            self.args.output_dir,
+            batch_size=self.args.train_batch_size * self.args.gradient_accumulation_steps,
+        )
+        self._instrumented_epoch = 0
+        self._accumulate = tf.function(self._accumulate_gradients) # traced once for the whole training
+
+    def train(self):
+        self.instrumentation.on_train_begin()
+        super().train()
+        self.instrumentation.on_train_end()
+
+    def _training_steps(self, ds, optimizer):
+        self.instrumentation.on_epoch_begin(self._instrumented_epoch)
+
+        steps = super()._training_steps(ds, optimizer)
+        step = 0
+        while True:
+            self.instrumentation.on_train_batch_begin(step)
+            try:
+                loss = next(steps)
+            except StopIteration:
+                self.instrumentation._reset_step()
+                break
+            self.instrumentation.on_train_batch_end(step)
+            yield loss
+            step += 1
+
+        self.instrumentation.on_epoch_end(self._instrumented_epoch)
+        self._instrumented_epoch += 1
+
+    def _accumulate_next_gradients(self, ds):
+        iterator = iter(ds)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                per_replica_features, per_replica_labels = next(iterator)
+            except (StopIteration, tf.errors.OutOfRangeError):
+                break
+            input_wait = time.perf_counter() - start
+
+            features = None
+            if 'attention_mask' in per_replica_features:
+                attention_masks = self.args.strategy.experimental_local_results(per_replica_features['attention_mask'])
+                features = {'attention_mask': tf.concat(attention_masks, axis=0)}
+            self.instrumentation.record_input_wait(input_wait, features)
+
+            yield self._accumulate(per_replica_features, per_replica_labels)